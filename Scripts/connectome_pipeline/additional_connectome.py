@@ -0,0 +1,800 @@
+import numpy as np
+
+
+# ==================================================================
+"""
+Streamline helpers
+These functions work directly on the flat point buffer of a tractogram so that
+per-streamline quantities can be computed without Python loops.
+"""
+
+
+def streamline_arrays(streamlines):
+    """Return the (points, offsets, lengths) arrays describing `streamlines`.
+
+    Streamlines and ArraySequence objects are used as they are, any other
+    sequence of (n, 3) arrays is concatenated first.
+    """
+    if hasattr(streamlines, '_offsets'):
+        return (streamlines._data,
+                np.asarray(streamlines._offsets, dtype=np.intp),
+                np.asarray(streamlines._lengths, dtype=np.intp))
+
+    lengths = np.array([len(sl) for sl in streamlines], dtype=np.intp)
+    offsets = np.zeros(len(lengths), dtype=np.intp)
+    offsets[1:] = np.cumsum(lengths)[:-1]
+    if len(lengths):
+        points = np.concatenate([np.asarray(sl) for sl in streamlines])
+    else:
+        points = np.zeros((0, 3))
+    return points, offsets, lengths
+
+
+def point_index(offsets, lengths):
+    """Streamline number and position in the point buffer of every point of
+    the streamlines described by `offsets` and `lengths`.
+    """
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    first = np.cumsum(lengths) - lengths
+    index = np.arange(len(rows)) + np.repeat(offsets - first, lengths)
+    return rows, index
+
+
+def streamline_lengths(points, offsets, lengths):
+    """Arc length of every streamline, computed from the flat point buffer."""
+    rows, index = point_index(offsets, lengths)
+    steps = np.sqrt(np.sum(np.diff(points[index], axis=0) ** 2, axis=1, dtype=np.float64))
+    same_streamline = rows[1:] == rows[:-1]
+    return np.bincount(rows[1:][same_streamline], weights=steps[same_streamline],
+                       minlength=len(lengths))
+
+
+def voxel_positions(points, affine):
+    """Continuous voxel coordinates of each point."""
+    inv_affine = np.linalg.inv(np.asarray(affine, dtype=float))
+    return np.dot(points, inv_affine[:3, :3].T) + inv_affine[:3, 3]
+
+
+def voxel_coordinates(points, affine):
+    """Nearest voxel index of each point, using the same rounding as dipy."""
+    return np.floor(voxel_positions(points, affine) + .5).astype(np.intp)
+
+
+def subdivide_segments(rows, points, max_step):
+    """Insert points along every segment longer than `max_step`, so that
+    consecutive points of a streamline are at most `max_step` apart.
+    `rows` gives the streamline number of every point.
+    """
+    same_streamline = rows[1:] == rows[:-1]
+    steps = np.zeros_like(points)
+    steps[:-1][same_streamline] = np.diff(points, axis=0)[same_streamline]
+
+    n_parts = np.maximum(np.ceil(np.sqrt(np.sum(steps ** 2, axis=1)) / max_step), 1).astype(np.intp)
+    start = np.repeat(np.arange(len(points)), n_parts)
+    fraction = (np.arange(len(start)) - np.repeat(np.cumsum(n_parts) - n_parts, n_parts)) / np.repeat(n_parts, n_parts)
+    return rows[start], points[start] + fraction[:, None] * steps[start]
+
+
+def lookup_labels(volume, ijk):
+    """Values of `volume` at the voxel indices `ijk`, 0 outside of the volume."""
+    inside = np.all((ijk >= 0) & (ijk < np.asarray(volume.shape[:3])), axis=1)
+    values = np.zeros(len(ijk), dtype=volume.dtype)
+    values[inside] = volume[tuple(ijk[inside].T)]
+    return values
+
+
+def endpoint_edges(points, offsets, lengths, labels, affine, n_labels):
+    """Edge of every streamline whose endpoints both lie in a labelled ROI.
+
+    Returns a boolean array marking the connected streamlines (at least two
+    points, both endpoints labelled) and their edge numbers
+    (ROI1 * n_labels + ROI2 with ROI1 <= ROI2, counting ROIs from 0).
+    """
+    first = voxel_coordinates(points[offsets], affine)
+    last = voxel_coordinates(points[offsets + np.maximum(lengths, 1) - 1], affine)
+    end_labels = np.sort(np.vstack([lookup_labels(labels, first),
+                                    lookup_labels(labels, last)]), axis=0).astype(np.intp)
+
+    connected = (end_labels[0] > 0) & (lengths > 1)
+    edges = (end_labels[0, connected] - 1) * n_labels + end_labels[1, connected] - 1
+    return connected, edges
+
+
+def rasmm_chunk(points, offsets, lengths, streamline_affine):
+    """Points of the streamlines described by `offsets` and `lengths` moved
+    to RAS+ mm with `streamline_affine`, with offsets into the new buffer.
+    """
+    rows, index = point_index(offsets, lengths)
+    points = np.dot(points[index], streamline_affine[:3, :3].T) + streamline_affine[:3, 3]
+    return points, np.cumsum(lengths) - lengths
+
+
+def edge_matrix(n_labels, edge_ids, values):
+    """Symmetric n_labels x n_labels matrix from values of upper-triangle edges."""
+    matrix = np.zeros(n_labels * n_labels, dtype=np.asarray(values).dtype)
+    matrix[edge_ids] = values
+    matrix = matrix.reshape(n_labels, n_labels)
+    return matrix + matrix.T - np.diag(np.diagonal(matrix))
+
+
+# ==================================================================
+"""
+Streaming edge length statistics
+Count, mean, minimum and maximum streamline length per edge, plus a
+quantile sketch for the median. The sketch stores counts in logarithmic
+length buckets (as in DDSketch), so any order statistic it returns is within
+`relative_accuracy` of the true one. Lengths are accumulated chunk by chunk,
+so no streamline needs to be kept. The lengths of edges with at most
+`exact_size` streamlines are also kept exactly, so their quantiles are the
+same as np.percentile; for larger edges quantiles interpolate between the
+two order statistics from the sketch in the same way.
+"""
+
+
+class EdgeLengthStatistics(object):
+
+    def __init__(self, n_labels, relative_accuracy=.01, min_length=1e-3, max_length=1e4, exact_size=32):
+        self.n_labels = n_labels
+        self.relative_accuracy = relative_accuracy
+        self.exact_size = exact_size
+        self.min_length = min_length
+        self._log_gamma = np.log((1 + relative_accuracy) / (1 - relative_accuracy))
+        self._bucket_offset = int(np.floor(np.log(min_length) / self._log_gamma))
+        self._n_buckets = int(np.ceil(np.log(max_length) / self._log_gamma)) - self._bucket_offset + 1
+
+        n_edges = n_labels * n_labels
+        self.count = np.zeros(n_edges, dtype=np.int64)
+        self.total = np.zeros(n_edges)
+        self.minimum = np.full(n_edges, np.inf)
+        self.maximum = np.zeros(n_edges)
+
+        # Sorted (edge, bucket) keys of the sketch and their counts
+        self._keys = np.zeros(0, dtype=np.int64)
+        self._key_counts = np.zeros(0, dtype=np.int64)
+
+        # Lengths of the edges with at most exact_size streamlines
+        self._exact_edges = np.zeros(0, dtype=np.int64)
+        self._exact_lengths = np.zeros(0)
+
+    def update(self, edges, lengths):
+        """Add the lengths of streamlines belonging to the given edges."""
+        edges = np.asarray(edges, dtype=np.int64)
+        lengths = np.asarray(lengths, dtype=np.float64)
+        n_edges = len(self.count)
+
+        self.count += np.bincount(edges, minlength=n_edges)
+        self.total += np.bincount(edges, weights=lengths, minlength=n_edges)
+        np.minimum.at(self.minimum, edges, lengths)
+        np.maximum.at(self.maximum, edges, lengths)
+
+        buckets = np.ceil(np.log(np.maximum(lengths, self.min_length)) / self._log_gamma)
+        buckets = np.clip(buckets.astype(np.int64) - self._bucket_offset, 0, self._n_buckets - 1)
+        keys = np.concatenate([self._keys, edges * self._n_buckets + buckets])
+        counts = np.concatenate([self._key_counts, np.ones(len(edges), dtype=np.int64)])
+        self._keys, inverse = np.unique(keys, return_inverse=True)
+        self._key_counts = np.bincount(inverse.ravel(), weights=counts).astype(np.int64)
+
+        exact_edges = np.concatenate([self._exact_edges, edges])
+        exact_lengths = np.concatenate([self._exact_lengths, lengths])
+        exact = self.count[exact_edges] <= self.exact_size
+        self._exact_edges = exact_edges[exact]
+        self._exact_lengths = exact_lengths[exact]
+
+    def edge_ids(self):
+        return np.flatnonzero(self.count)
+
+    def quantile(self, q):
+        """q-quantile (0 <= q <= 1) of the lengths of every connected edge,
+        in the order of edge_ids(), interpolated between order statistics as
+        np.percentile does. Exact for edges with at most exact_size
+        streamlines, approximate for the others.
+        """
+        edge_ids = self.edge_ids()
+        position = q * (self.count[edge_ids] - 1)
+        lower = np.floor(position).astype(np.int64)
+        upper = np.ceil(position).astype(np.int64)
+        fraction = position - lower
+
+        # Order statistics from the sketch
+        cumulative = np.cumsum(self._key_counts)
+        first_key = np.searchsorted(self._keys, edge_ids * self._n_buckets)
+        before = cumulative[first_key] - self._key_counts[first_key]
+        gamma = np.exp(self._log_gamma)
+
+        def order_statistic(rank):
+            key = self._keys[np.searchsorted(cumulative, before + rank + 1)]
+            # Representative value of the bucket
+            bucket = key % self._n_buckets + self._bucket_offset
+            return 2 * gamma ** bucket / (gamma + 1)
+
+        low = order_statistic(lower)
+        high = order_statistic(upper)
+
+        # Exact order statistics of small edges
+        exact = self.count[edge_ids] <= self.exact_size
+        order = np.lexsort((self._exact_lengths, self._exact_edges))
+        ordered = self._exact_lengths[order]
+        start = np.searchsorted(self._exact_edges[order], edge_ids[exact])
+        low[exact] = ordered[start + lower[exact]]
+        high[exact] = ordered[start + upper[exact]]
+
+        return low + fraction * (high - low)
+
+    def count_matrix(self):
+        edge_ids = self.edge_ids()
+        return edge_matrix(self.n_labels, edge_ids, self.count[edge_ids])
+
+    def mean_matrix(self):
+        edge_ids = self.edge_ids()
+        return edge_matrix(self.n_labels, edge_ids, self.total[edge_ids] / self.count[edge_ids])
+
+    def min_matrix(self):
+        edge_ids = self.edge_ids()
+        return edge_matrix(self.n_labels, edge_ids, self.minimum[edge_ids])
+
+    def max_matrix(self):
+        edge_ids = self.edge_ids()
+        return edge_matrix(self.n_labels, edge_ids, self.maximum[edge_ids])
+
+    def median_matrix(self):
+        return edge_matrix(self.n_labels, self.edge_ids(), self.quantile(.5))
+
+
+# ==================================================================
+"""
+Connectome engine
+Assigns the endpoints of every streamline to the labels of a parcellation
+once, chunk by chunk. Density, ROI-size normalised, median length and length
+normalised matrices are then obtained with vectorised reductions over the
+label pairs, in ConnectomeMatrices. Matrices exclude the background label,
+i.e. row/column i belongs to label i+1.
+"""
+
+
+class ConnectomeMatrices(object):
+    """Matrices computed from the connected ROI pairs, shared by the
+    connectome engines. Subclasses provide labels, n_labels, edge_ids,
+    edge_counts, length_statistics and edge_voxel_counts().
+    """
+
+    def _to_matrix(self, values):
+        return edge_matrix(self.n_labels, self.edge_ids, values)
+
+    def roi_sizes(self):
+        """Number of voxels in each ROI."""
+        return np.bincount(self.labels.ravel(), minlength=self.n_labels + 1)[1:]
+
+    def density_matrix(self):
+        """Number of streamlines connecting each pair of ROIs."""
+        return self._to_matrix(self.edge_counts)
+
+    def median_length_matrix(self):
+        """Median streamline length for each pair of ROIs, 0 if unconnected.
+        Exact for pairs with few streamlines, otherwise approximated by the
+        length sketch within its relative accuracy.
+        """
+        return self.length_statistics.median_matrix()
+
+    def size_normalized_matrix(self, matrix):
+        """`matrix` divided by the combined number of voxels of each ROI pair."""
+        sizes = self.roi_sizes()
+        return _safe_divide(matrix, sizes[:, np.newaxis] + sizes[np.newaxis, :])
+
+    def length_normalized_matrix(self, matrix):
+        """`matrix` divided by the median streamline length of each ROI pair."""
+        return _safe_divide(matrix, self.median_length_matrix())
+
+    def scalar_matrix(self, scalar_data, min_streamlines=5):
+        """Mean of `scalar_data` over the voxels visited by more than
+        `min_streamlines` streamlines of each ROI pair.
+        """
+        counts = self.edge_voxel_counts()
+        n_edges = len(self.edge_ids)
+        rows = np.repeat(np.arange(n_edges), np.diff(counts.indptr))
+        keep = counts.data > min_streamlines
+        values = np.asarray(scalar_data).ravel()[counts.indices[keep]]
+
+        total = np.bincount(rows[keep], weights=values, minlength=n_edges)
+        n_voxels = np.bincount(rows[keep], minlength=n_edges)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = total / n_voxels
+        return self._to_matrix(mean)
+
+
+class StreamlineConnectome(ConnectomeMatrices):
+
+    def __init__(self, streamlines, labels, affine, relative_accuracy=.01, chunk_size=10000,
+                 streamline_affine=None, max_step=None):
+        # streamline_affine maps the streamline coordinates to RAS+ mm, e.g.
+        # for voxel-space streamlines read from a tractogram container.
+        # max_step (in voxels) subdivides longer segments of compressed
+        # streamlines when looking up the voxels they visit.
+        self.max_step = max_step
+        self.streamlines = streamlines
+        self.labels = np.asarray(labels).astype(np.intp)
+        self.affine = np.asarray(affine, dtype=float)
+        self.streamline_affine = None
+        if streamline_affine is not None:
+            self.streamline_affine = np.asarray(streamline_affine, dtype=float)
+        self.n_labels = int(self.labels.max())
+        self.length_statistics = EdgeLengthStatistics(self.n_labels, relative_accuracy)
+
+        points, offsets, lengths = streamline_arrays(streamlines)
+
+        streamline_index = list()
+        edges = list()
+        for start in range(0, len(lengths), chunk_size):
+            chunk_offsets = offsets[start:start + chunk_size]
+            chunk_lengths = lengths[start:start + chunk_size]
+            chunk_points = points
+            if self.streamline_affine is not None:
+                # Lengths are measured in mm, so the chunk is moved to RAS+ first
+                chunk_points, chunk_offsets = rasmm_chunk(points, chunk_offsets, chunk_lengths,
+                                                          self.streamline_affine)
+            connected, chunk_edges = endpoint_edges(chunk_points, chunk_offsets, chunk_lengths,
+                                                    self.labels, self.affine, self.n_labels)
+            self.length_statistics.update(chunk_edges, streamline_lengths(
+                chunk_points, chunk_offsets[connected], chunk_lengths[connected]))
+            streamline_index.append(start + np.flatnonzero(connected))
+            edges.append(chunk_edges)
+
+        self.streamline_index = np.concatenate(streamline_index + [np.zeros(0, dtype=np.intp)])
+        self.edges = np.concatenate(edges + [np.zeros(0, dtype=np.intp)])
+
+        # Grouping the streamlines by edge
+        self._order = np.argsort(self.edges, kind='stable')
+        self.edge_ids, self.edge_counts = np.unique(self.edges[self._order], return_counts=True)
+        self._edge_voxels = None
+
+    def edge_voxel_counts(self):
+        """Sparse (edges x voxels) matrix with the number of streamlines of
+        each connected ROI pair that visit each voxel.
+
+        Built once from the streamline-voxel incidence index and reused for
+        every scalar map.
+        """
+        from scipy import sparse
+
+        if self._edge_voxels is None:
+            voxel_affine = self.affine
+            if self.streamline_affine is not None:
+                voxel_affine = np.dot(np.linalg.inv(self.streamline_affine), self.affine)
+            index = StreamlineVoxelIndex(self.streamlines[self.streamline_index],
+                                         self.labels.shape, voxel_affine, max_step=self.max_step)
+            groups = np.repeat(np.arange(len(self.edge_ids)), self.edge_counts)
+            membership = sparse.csr_matrix(
+                (np.ones(len(groups)), (groups, self._order)),
+                shape=(len(self.edge_ids), len(self.streamline_index)))
+            self._edge_voxels = membership.dot(index.matrix).tocsr()
+        return self._edge_voxels
+
+
+# ==================================================================
+"""
+Streaming connectome
+Accumulates the connectome while streamlines are generated, so the
+tractogram never has to be kept or written. Every chunk updates the edge
+length statistics and a sparse (edges x voxels) matrix of streamline visits,
+which is all ConnectomeMatrices needs for the matrices, including the scalar
+matrices of scalar maps that are only known later. The accumulated state is
+saved to a small .npz file that CalcMatrix reads instead of a tractogram.
+"""
+
+
+class StreamingConnectome(ConnectomeMatrices):
+
+    def __init__(self, labels, affine, relative_accuracy=.01, streamline_affine=None, max_step=None):
+        from scipy import sparse
+
+        self.labels = np.asarray(labels).astype(np.intp)
+        self.affine = np.asarray(affine, dtype=float)
+        self.streamline_affine = None
+        if streamline_affine is not None:
+            self.streamline_affine = np.asarray(streamline_affine, dtype=float)
+        self.max_step = max_step
+        self.n_labels = int(self.labels.max())
+        self.length_statistics = EdgeLengthStatistics(self.n_labels, relative_accuracy)
+
+        self._voxel_affine = self.affine
+        if self.streamline_affine is not None:
+            self._voxel_affine = np.dot(np.linalg.inv(self.streamline_affine), self.affine)
+        self._shape = (self.n_labels * self.n_labels, self.labels.size)
+        self._visits = sparse.csr_matrix(self._shape, dtype=np.int64)
+        self._pending = list()
+
+    def add(self, chunk):
+        """Assign a chunk of streamlines to the ROIs and accumulate it."""
+        from scipy import sparse
+
+        points, offsets, lengths = streamline_arrays(chunk)
+        if self.streamline_affine is not None:
+            points, offsets = rasmm_chunk(points, offsets, lengths, self.streamline_affine)
+        connected, edges = endpoint_edges(points, offsets, lengths, self.labels, self.affine, self.n_labels)
+        self.length_statistics.update(edges, streamline_lengths(points, offsets[connected], lengths[connected]))
+
+        index = StreamlineVoxelIndex(chunk[np.flatnonzero(connected)], self.labels.shape,
+                                     self._voxel_affine, max_step=self.max_step)
+        membership = sparse.csr_matrix((np.ones(len(edges), dtype=np.int64), (edges, np.arange(len(edges)))),
+                                       shape=(self._shape[0], len(edges)))
+        self._pending.append(membership.dot(index.matrix))
+        # Chunk results are summed in batches to bound the cost of merging
+        if len(self._pending) >= 16:
+            self._merge()
+
+    def accumulate(self, chunks):
+        """Pass on streamline chunks, adding each to the connectome."""
+        for chunk in chunks:
+            self.add(chunk)
+            yield chunk
+
+    def _merge(self):
+        for visits in self._pending:
+            self._visits = self._visits + visits
+        self._pending = list()
+
+    @property
+    def edge_ids(self):
+        return self.length_statistics.edge_ids()
+
+    @property
+    def edge_counts(self):
+        return self.length_statistics.count[self.edge_ids]
+
+    def edge_voxel_counts(self):
+        self._merge()
+        return self._visits[self.edge_ids]
+
+    def save(self, filename):
+        """Save the accumulated state; the parcellation is not included."""
+        self._merge()
+        statistics = self.length_statistics
+        visits = self._visits.tocsr()
+        np.savez_compressed(filename, n_labels=self.n_labels, relative_accuracy=statistics.relative_accuracy,
+                            count=statistics.count, total=statistics.total,
+                            minimum=statistics.minimum, maximum=statistics.maximum,
+                            keys=statistics._keys, key_counts=statistics._key_counts,
+                            exact_size=statistics.exact_size, exact_edges=statistics._exact_edges,
+                            exact_lengths=statistics._exact_lengths,
+                            visits_data=visits.data, visits_indices=visits.indices, visits_indptr=visits.indptr)
+
+    @classmethod
+    def load(cls, filename, labels, affine):
+        """Streaming connectome saved with save(), for the same parcellation."""
+        from scipy import sparse
+
+        with np.load(filename) as saved:
+            connectome = cls(labels, affine, float(saved['relative_accuracy']))
+            if int(saved['n_labels']) != connectome.n_labels:
+                raise ValueError(filename + ' was accumulated with a different parcellation')
+            statistics = connectome.length_statistics
+            statistics.count = saved['count']
+            statistics.total = saved['total']
+            statistics.minimum = saved['minimum']
+            statistics.maximum = saved['maximum']
+            statistics._keys = saved['keys']
+            statistics._key_counts = saved['key_counts']
+            statistics.exact_size = int(saved['exact_size'])
+            statistics._exact_edges = saved['exact_edges']
+            statistics._exact_lengths = saved['exact_lengths']
+            connectome._visits = sparse.csr_matrix(
+                (saved['visits_data'], saved['visits_indices'], saved['visits_indptr']), shape=connectome._shape)
+        return connectome
+
+
+# ==================================================================
+"""
+Streamline-voxel incidence index
+Sparse (streamlines x voxels) matrix in CSR format. Entry (s, v) is 1 if
+streamline s has at least one point in voxel v, matching the way
+dipy's density_map counts streamlines. Summing rows of the index gives the
+density map of any group of streamlines without traversing them again.
+For compressed streamlines, segments longer than max_step voxels are
+subdivided so that the voxels they cross are not skipped.
+"""
+
+
+class StreamlineVoxelIndex(object):
+
+    def __init__(self, streamlines, shape, affine, chunk_size=10000, max_step=None):
+        from scipy import sparse
+
+        points, offsets, lengths = streamline_arrays(streamlines)
+        self.shape = tuple(shape[:3])
+        n_voxels = int(np.prod(self.shape))
+
+        blocks = list()
+        for start in range(0, max(len(lengths), 1), chunk_size):
+            chunk_offsets = offsets[start:start + chunk_size]
+            chunk_lengths = lengths[start:start + chunk_size]
+
+            rows, index = point_index(chunk_offsets, chunk_lengths)
+            positions = voxel_positions(points[index], affine)
+            if max_step is not None:
+                rows, positions = subdivide_segments(rows, positions, max_step)
+            ijk = np.floor(positions + .5).astype(np.intp)
+            inside = np.all((ijk >= 0) & (ijk < np.asarray(self.shape)), axis=1)
+            voxels = np.ravel_multi_index(tuple(ijk[inside].T), self.shape)
+
+            block = sparse.csr_matrix((np.ones(len(voxels), dtype=np.int32), (rows[inside], voxels)),
+                                      shape=(len(chunk_lengths), n_voxels))
+            block.sum_duplicates()
+            block.data[:] = 1
+            blocks.append(block)
+
+        self.matrix = sparse.vstack(blocks, format='csr')
+
+    def density_map(self, index=None):
+        """Number of streamlines visiting each voxel, optionally restricted
+        to the streamlines in `index`.
+        """
+        matrix = self.matrix if index is None else self.matrix[index]
+        counts = np.asarray(matrix.sum(axis=0)).ravel()
+        return counts.reshape(self.shape)
+
+
+def _safe_divide(numerator, denominator):
+    numerator = np.asarray(numerator, dtype=float)
+    result = np.zeros(np.broadcast(numerator, denominator).shape)
+    np.divide(numerator, denominator, out=result, where=denominator > 0)
+    return result
+
+
+# ==================================================================
+"""
+Cohort connectome store
+Binary, append-only store for the connectivity matrices of a whole cohort.
+Matrices of each atlas are written as consecutive float32 N x N frames to
+<atlas>.f32, which can be memory-mapped as a (frames, N, N) array. index.csv
+records subject, atlas, model (e.g. the tractography model, so that matrices
+from different models of one subject are not mixed), kind, scalar, threshold
+and frame for every matrix.
+Appends from concurrent subject runs are serialised with a file lock, and a
+later append for the same subject and matrix replaces the earlier one. Frames
+past the last indexed one, left by an append that was interrupted, are
+truncated before the next append, so frames stay aligned.
+"""
+
+
+class CohortConnectomeStore(object):
+    fields = ['subject', 'atlas', 'model', 'kind', 'scalar', 'threshold', 'size', 'frame']
+    dtype = np.float32
+
+    def __init__(self, path):
+        import os
+        self.path = os.path.abspath(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.index_file = os.path.join(self.path, 'index.csv')
+
+    def _data_file(self, atlas):
+        import os
+        return os.path.join(self.path, atlas + '.f32')
+
+    def _locked(self):
+        import fcntl
+        import os
+        from contextlib import contextmanager
+
+        @contextmanager
+        def lock():
+            with open(os.path.join(self.path, '.lock'), 'w') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return lock()
+
+    def append(self, subject, atlas, matrices, model=''):
+        """Append matrices of one subject and model.
+
+        matrices is a list of (kind, scalar, threshold, matrix) tuples, with
+        scalar '' for streamline matrices and threshold None for matrices
+        that do not depend on it.
+        """
+        import csv
+        import os
+
+        size = matrices[0][3].shape[0]
+        with self._locked():
+            existing = self.records(atlas=atlas)
+            if existing and existing[0]['size'] != size:
+                raise ValueError('atlas %s holds %dx%d matrices, got %dx%d' %
+                                 (atlas, existing[0]['size'], existing[0]['size'], size, size))
+
+            data_file = self._data_file(atlas)
+            frame_bytes = size * size * np.dtype(self.dtype).itemsize
+            first_frame = max(record['frame'] for record in existing) + 1 if existing else 0
+
+            with open(data_file, 'ab') as f:
+                if os.path.getsize(data_file) > first_frame * frame_bytes:
+                    f.truncate(first_frame * frame_bytes)
+                for _, _, _, matrix in matrices:
+                    f.write(np.ascontiguousarray(matrix, dtype=self.dtype).tobytes())
+
+            new_index = not os.path.exists(self.index_file)
+            with open(self.index_file, 'a') as f:
+                writer = csv.writer(f)
+                if new_index:
+                    writer.writerow(self.fields)
+                for frame, (kind, scalar, threshold, _) in enumerate(matrices, first_frame):
+                    writer.writerow([subject, atlas, model, kind, scalar,
+                                     '' if threshold is None else threshold, size, frame])
+
+    def records(self, **criteria):
+        """Index entries matching all the given field values."""
+        import csv
+        import os
+
+        if not os.path.exists(self.index_file):
+            return []
+        records = list()
+        with open(self.index_file) as f:
+            for record in csv.DictReader(f):
+                record['threshold'] = int(record['threshold']) if record['threshold'] else None
+                record['size'] = int(record['size'])
+                record['frame'] = int(record['frame'])
+                if all(record[field] == value for field, value in criteria.items()):
+                    records.append(record)
+        return records
+
+    def memmap(self, atlas):
+        """All frames of an atlas as a read-only (frames, N, N) memory map."""
+        size = self.records(atlas=atlas)[0]['size']
+        return np.memmap(self._data_file(atlas), dtype=self.dtype, mode='r').reshape(-1, size, size)
+
+    def stack(self, atlas, kind='density', scalar='', threshold=0, subjects=None, model=''):
+        """Subject x N x N stack of one matrix kind of one model.
+
+        Returns the subject IDs and the matrices; only the frames of the
+        selected subjects are read from disk.
+        """
+        frames = dict()
+        for record in self.records(atlas=atlas, model=model, kind=kind, scalar=scalar, threshold=threshold):
+            frames[record['subject']] = record['frame']
+        if subjects is None:
+            subjects = sorted(frames)
+        matrices = self.memmap(atlas)[[frames[subject] for subject in subjects]]
+        return list(subjects), np.asarray(matrices)
+
+    def to_hdf5(self, filename):
+        """Export every matrix kind as /<atlas>[/<model>]/<kind>[_<scalar>]/threshold_<t>
+        datasets with a 'subjects' attribute.
+
+        Datasets are written so that MATLAB's h5read returns them as
+        subject x N x N, like example_rewired_connectomes.
+        """
+        import h5py
+
+        keys = list()
+        for record in self.records():
+            key = (record['atlas'], record['model'], record['kind'], record['scalar'], record['threshold'])
+            if key not in keys:
+                keys.append(key)
+
+        with h5py.File(filename, 'w') as f:
+            for atlas, model, kind, scalar, threshold in keys:
+                subjects, matrices = self.stack(atlas, kind, scalar, threshold, model=model)
+                name = '/'.join([atlas] + ([model] if model else []) + [kind + ('_' + scalar if scalar else ''),
+                                 'all' if threshold is None else 'threshold_' + str(threshold)])
+                dataset = f.create_dataset(name, data=matrices.transpose(2, 1, 0),
+                                           compression='gzip')
+                dataset.attrs['subjects'] = ','.join(subjects)
+
+
+# ==================================================================
+"""
+Tractogram container
+Compact single-file format for streamlines: a float32 point buffer followed
+by offsets, lengths, optional per-streamline metadata arrays and a JSON
+footer that records the voxel-to-RAS affine, the volume dimensions, free-form
+attributes (e.g. the compression tolerance) and the position of every array. Points are appended chunk by chunk while tracking
+runs, and the arrays are opened zero-copy as memory maps when reading.
+"""
+
+CONTAINER_MAGIC = b'STRMLNS1'
+
+
+class TractogramContainerWriter(object):
+
+    def __init__(self, filename, affine, dimensions, **attributes):
+        self.filename = filename
+        self.affine = np.asarray(affine, dtype=float)
+        self.dimensions = [int(d) for d in dimensions[:3]]
+        self.attributes = attributes
+        self._file = open(filename, 'wb')
+        self._file.write(CONTAINER_MAGIC)
+        self._lengths = list()
+        self._metadata = dict()
+
+    def append(self, streamlines, **metadata):
+        """Append a chunk of streamlines and optional per-streamline values."""
+        points, offsets, lengths = streamline_arrays(streamlines)
+        rows, index = point_index(offsets, lengths)
+        self._file.write(np.ascontiguousarray(points[index], dtype='<f4').tobytes())
+        self._lengths.append(np.asarray(lengths, dtype=np.int64))
+        for name, values in metadata.items():
+            self._metadata.setdefault(name, list()).append(np.asarray(values))
+
+    def _write_array(self, array, arrays, name):
+        # Arrays start at 8-byte boundaries
+        padding = -self._file.tell() % 8
+        self._file.write(b'\0' * padding)
+        arrays[name] = dict(offset=self._file.tell(), dtype=array.dtype.str, shape=list(array.shape))
+        self._file.write(np.ascontiguousarray(array).tobytes())
+
+    def close(self):
+        import json
+        import struct
+
+        lengths = np.concatenate(self._lengths + [np.zeros(0, dtype=np.int64)])
+        offsets = np.cumsum(lengths) - lengths
+        arrays = dict(points=dict(offset=len(CONTAINER_MAGIC), dtype='<f4',
+                                  shape=[int(lengths.sum()), 3]))
+        self._write_array(offsets, arrays, 'offsets')
+        self._write_array(lengths, arrays, 'lengths')
+        for name, values in self._metadata.items():
+            self._write_array(np.concatenate(values), arrays, 'metadata/' + name)
+
+        footer = json.dumps(dict(affine=self.affine.tolist(), dimensions=self.dimensions,
+                                 attributes=self.attributes, arrays=arrays)).encode()
+        self._file.write(footer)
+        self._file.write(struct.pack('<Q', len(footer)))
+        self._file.write(CONTAINER_MAGIC)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TractogramContainer(object):
+    """Memory-mapped view of a tractogram container. Streamline coordinates
+    are in voxel space, `affine` maps them to RAS+ mm.
+    """
+
+    def __init__(self, filename):
+        import json
+        import struct
+
+        with open(filename, 'rb') as f:
+            f.seek(-8 - len(CONTAINER_MAGIC), 2)
+            footer_length, = struct.unpack('<Q', f.read(8))
+            if f.read() != CONTAINER_MAGIC:
+                raise ValueError(filename + ' is not a tractogram container')
+            f.seek(-8 - len(CONTAINER_MAGIC) - footer_length, 2)
+            footer = json.loads(f.read(footer_length).decode())
+
+        self.filename = filename
+        self.affine = np.array(footer['affine'])
+        self.dimensions = tuple(footer['dimensions'])
+        self.attributes = footer.get('attributes', dict())
+        self._arrays = footer['arrays']
+
+        self.points = self._memmap('points')
+        self.offsets = self._memmap('offsets')
+        self.lengths = self._memmap('lengths')
+        self.metadata = dict((name.split('/', 1)[1], self._memmap(name))
+                             for name in self._arrays if name.startswith('metadata/'))
+
+    def _memmap(self, name):
+        array = self._arrays[name]
+        if not np.prod(array['shape']):
+            return np.zeros(array['shape'], dtype=array['dtype'])
+        return np.memmap(self.filename, dtype=array['dtype'], mode='r',
+                         offset=array['offset'], shape=tuple(array['shape']))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    @property
+    def streamlines(self):
+        """Streamlines (ArraySequence) backed by the memory-mapped buffers."""
+        from dipy.tracking.streamline import Streamlines
+        streamlines = Streamlines()
+        streamlines._data = self.points
+        streamlines._offsets = np.asarray(self.offsets, dtype=np.intp)
+        streamlines._lengths = np.asarray(self.lengths, dtype=np.intp)
+        return streamlines
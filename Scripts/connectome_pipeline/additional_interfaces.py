@@ -3,6 +3,9 @@ from nipype.interfaces.base import BaseInterfaceInputSpec
 from nipype.interfaces.base import CommandLineInputSpec
 from nipype.interfaces.base import CommandLine
 from nipype.interfaces.base import File
+from nipype.interfaces.base import InputMultiPath
+from nipype.interfaces.base import isdefined
+from nipype.interfaces.base import OutputMultiPath
 from nipype.interfaces.base import traits
 from nipype.interfaces.base import TraitedSpec
 
@@ -30,20 +33,20 @@ class AdditionalDTIMeasures(BaseInterface):
     output_spec = AdditionalDTIMeasuresOutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
         from nipype.utils.filemanip import split_filename
+        from additional_io import load_image
+        from additional_io import save_image
 
-        L1 = nib.load(self.inputs.L1).get_data()
-        L2 = nib.load(self.inputs.L2).get_data()
-        L3 = nib.load(self.inputs.L3).get_data()
-        affine = nib.load(self.inputs.L1).get_affine()
+        L1_img, L1 = load_image(self.inputs.L1)
+        _, L2 = load_image(self.inputs.L2)
+        _, L3 = load_image(self.inputs.L3)
 
         RD = (L2 + L3) / 2
 
         fname = self.inputs.L1
         _, base, _ = split_filename(fname)
-        nib.save(nib.Nifti1Image(L1, affine), base + '_AD.nii.gz')
-        nib.save(nib.Nifti1Image(RD, affine), base + '_RD.nii.gz')
+        save_image(L1, L1_img.affine, base + '_AD.nii.gz')
+        save_image(RD, L1_img.affine, base + '_RD.nii.gz')
         return runtime
 
     def _list_outputs(self):
@@ -172,12 +175,15 @@ class AparcStats(BaseInterface):
 # ==================================================================
 """
 Extract values for regions in an atlas (volume data)
+All morphometry images are summarised in one pass over the atlas labels and
+written to a single table.
 """
 
 
 class AtlasValues_InputSpec(BaseInterfaceInputSpec):
     atlas_filename = File(exists=True, desc="filename of atlas data")
-    morpho_filename = File(exists=True, desc="filename of morphometry image")
+    morpho_filename = InputMultiPath(File(exists=True), desc="filenames of morphometry images, e.g. FA, RD, AD and MD")
+    percentiles = traits.List(traits.Float, [5., 25., 75., 95.], usedefault=True, desc="percentiles to report for each region")
 
 
 class AtlasValues_OutputSpec(TraitedSpec):
@@ -190,42 +196,33 @@ class AtlasValues(BaseInterface):
     output_spec = AtlasValues_OutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
         from nipype.utils.filemanip import split_filename
-        import numpy as np
-        import pandas as pd
-
-        atlas_filename = self.inputs.atlas_filename
-        morpho_filename = self.inputs.morpho_filename
+        from additional_io import load_image
+        from additional_parcellation import regional_statistics
 
-        atlas = nib.load(atlas_filename).get_data()
-        morpho = nib.load(morpho_filename).get_data()
-        results = pd.DataFrame()
-        metric = morpho_filename.split('/')[-1].split('_')[1]
-        atlas_name = atlas_filename.split('/')[-1].split('.nii.gz')[0]
+        _, atlas = load_image(self.inputs.atlas_filename)
 
-        for region in np.unique(atlas):
-            region_mask = np.asarray(atlas == region).astype('float64')
-            results.set_value(
-                region - 1, 'value', np.sum(morpho * region_mask) / np.sum(region_mask))
+        # The metric name is the last part of the file name, e.g. subject_FA
+        metrics = list()
+        images = list()
+        for morpho_filename in self.inputs.morpho_filename:
+            _, base, _ = split_filename(morpho_filename)
+            metrics.append(base.split('_')[-1])
+            images.append(load_image(morpho_filename)[1])
 
-        _, base, _ = split_filename(morpho_filename)
-        results.to_csv(base + '_' + metric + '_' + atlas_name + '.csv')
+        results = regional_statistics(atlas, images, metrics, self.inputs.percentiles)
+        results.to_csv(self._out_file())
 
         return runtime
 
-    def _list_outputs(self):
-        from nipype.utils.filemanip import split_filename
+    def _out_file(self):
         import os
+        atlas_name = self.inputs.atlas_filename.split('/')[-1].split('.nii.gz')[0]
+        return os.path.abspath(atlas_name + '_values.csv')
 
+    def _list_outputs(self):
         outputs = self._outputs().get()
-        atlas_filename = self.inputs.atlas_filename
-        morpho_filename = self.inputs.morpho_filename
-        _, base, _ = split_filename(morpho_filename)
-        metric = morpho_filename.split('/')[-1].split('_')[1]
-        atlas_name = atlas_filename.split('/')[-1].split('.nii.gz')[0]
-        atlas_name = atlas_filename.split('/')[-1].split('.nii.gz')[0]
-        outputs['atlas_values'] = os.path.abspath(base + '_' + metric + '_' + atlas_name + '.csv')
+        outputs['atlas_values'] = self._out_file()
         return outputs
 
 # ======================================================================
@@ -233,20 +230,28 @@ class AtlasValues(BaseInterface):
 
 class CalcMatrixInputSpec(BaseInterfaceInputSpec):
     track_file = File(
-        exists=True, desc='whole-brain tractography in .trk format', mandatory=True)
+        exists=True, desc='whole-brain tractography in .trk format or as a tractogram container (.sls), which is memory-mapped instead of parsed, or a connectome accumulated by Tractography in the fused mode (.npz)', mandatory=True)
     ROI_file = File(
         exists=True, desc='image containing the ROIs', mandatory=True)
-    scalar_file = File(
-        exists=True, desc='fractional anisotropy map in the same soace as the track file', mandatory=True)
+    scalar_file = InputMultiPath(File(exists=True),
+        desc='scalar maps (e.g. FA, RD, GFA) in the same space as the track file, all computed from one streamline mapping', mandatory=True)
     output_file = File(
         "scalar_matrix.txt", desc="Adjacency matrix of ROIs with scalar as conenction weight", usedefault=True)
     threshold = traits.Int(desc="Threshold of number of streamlines to retain")
+    thresholds = traits.List(traits.Int, desc="Thresholds of number of streamlines to retain, all written from a single run. Overrides threshold")
+    length_accuracy = traits.Float(.01, usedefault=True, desc="relative accuracy of the streamed median streamline length per ROI pair")
+    save_text = traits.Bool(True, usedefault=True, desc="write the matrices as tab-separated text files")
+    cohort_store = traits.String(desc="directory of a cohort connectome store to append the matrices to")
+    subject_id = traits.String(desc="subject ID in the cohort store, defaults to the track file name")
+    model = traits.String('', usedefault=True, desc="tractography model recorded with the matrices in the cohort store")
+    atlas_name = traits.String(desc="atlas name in the cohort store, defaults to the ROI file name")
 
 class CalcMatrixOutputSpec(TraitedSpec):
-    density_matrix = File(exists=True, desc="connectivity matrix based on the number of streamlines between each pair of ROIs")
-    length_normalized_matrix = File(exists=True, desc="streamline density matrix normalized by the length of the streamlines between ROIs")
-    scalar_matrix = File(exists=True, desc="connectivity matrix of scalar between each pair of ROIs")
-    size_normalized_matrix = File(exists=True, desc="streamline density matrix normalized by the combined volume of the ROIs")
+    density_matrix = OutputMultiPath(File(exists=True), desc="connectivity matrix based on the number of streamlines between each pair of ROIs, one per threshold")
+    length_normalized_matrix = OutputMultiPath(File(exists=True), desc="streamline density matrix normalized by the length of the streamlines between ROIs, one per threshold")
+    scalar_matrix = OutputMultiPath(File(exists=True), desc="connectivity matrix of scalar between each pair of ROIs, one per scalar map and threshold")
+    size_normalized_matrix = OutputMultiPath(File(exists=True), desc="streamline density matrix normalized by the combined volume of the ROIs, one per threshold")
+    median_length_matrix = File(exists=True, desc="median length of the streamlines between each pair of ROIs")
 
 
 class CalcMatrix(BaseInterface):
@@ -254,113 +259,139 @@ class CalcMatrix(BaseInterface):
     output_spec = CalcMatrixOutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
         import numpy as np
-        from dipy.tracking import utils
         from dipy.io.streamline import load_tractogram
-        from dipy.tracking.streamline import Streamlines
-
-        # Identity matrix affine
-        affine = np.eye(4)
+        from additional_io import load_image
 
         # Loading the ROI file
-        labels_img = nib.load(self.inputs.ROI_file)
-        labels = labels_img.get_data()
-
-        # Getting the scalar data
-        scalar_img = nib.load(self.inputs.scalar_file)
-        scalar_data = scalar_img.get_data()
-
-        # Loading the streamlines
-        streamlines = load_tractogram(self.inputs.track_file,
-                                      reference=scalar_img,
-                                      trk_header_check=True,
-                                      bbox_valid_check=False)
-        streamlines.to_rasmm()
-
-        # Only keeping streamlines that pass through the ROIs
-        ROI_mask = labels > 0
-        target_streamlines = utils.target(streamlines.streamlines, target_mask=ROI_mask, affine=labels_img.affine)
-        target_streamlines = Streamlines(target_streamlines)
-        lengths = np.array([len(sl) for sl in target_streamlines])
-        target_streamlines = target_streamlines[lengths > 1]
-
-        # Constructing the streamlines matrix
-        matrix, mapping = utils.connectivity_matrix(
-            streamlines=target_streamlines,
-            label_volume=labels.astype('int'),
-            affine=labels_img.affine,
-            symmetric=True,
-            return_mapping=True,
-            mapping_as_streamlines=True)
-
-        matrix[matrix < self.inputs.threshold] = 0
-
-        # Removing the background label
-        matrix = matrix[1:, :]
-        matrix = matrix[:, 1:]
-
-        # Saving the density matrix
+        labels_img, labels = load_image(self.inputs.ROI_file)
+
+        # Loading the streamlines. A tractogram container is memory-mapped in
+        # voxel space and moved to RAS+ chunk by chunk. A connectome
+        # accumulated during tracking is used as it is.
+        from additional_connectome import StreamlineConnectome
+        from additional_connectome import StreamingConnectome
+        if self.inputs.track_file.endswith('.npz'):
+            streamlines = None
+        elif self.inputs.track_file.endswith('.sls'):
+            from additional_connectome import TractogramContainer
+            container = TractogramContainer(self.inputs.track_file)
+            streamlines = container.streamlines
+            streamline_affine = container.affine
+            # Compressed streamlines are subdivided to find the voxels they cross
+            max_step = .5 if container.attributes.get('tol_error') else None
+        else:
+            scalar_img, _ = load_image(self.inputs.scalar_file[0], lazy=True)
+            tractogram = load_tractogram(self.inputs.track_file,
+                                         reference=scalar_img,
+                                         trk_header_check=True,
+                                         bbox_valid_check=False)
+            tractogram.to_rasmm()
+            streamlines = tractogram.streamlines
+            streamline_affine = None
+            from additional_tracking import trk_attributes
+            max_step = .5 if trk_attributes(self.inputs.track_file).get('tol_error') else None
+
+        # Assigning the streamline endpoints to the ROIs. A streamline with
+        # both endpoints in an ROI passes through the ROI mask, so no separate
+        # targeting step is needed.
+        if streamlines is None:
+            connectome = StreamingConnectome.load(self.inputs.track_file, labels, labels_img.affine)
+        else:
+            connectome = StreamlineConnectome(streamlines, labels, labels_img.affine,
+                                              relative_accuracy=self.inputs.length_accuracy,
+                                              streamline_affine=streamline_affine, max_step=max_step)
+
         from nipype.utils.filemanip import split_filename
         _, base, _ = split_filename(self.inputs.track_file)
-        np.savetxt(base + '_' + str(self.inputs.threshold) + '_matrix.txt', matrix, delimiter='\t')
-
-        # Density matrix normalized by ROI size
-        ROI_sizes = [np.sum(labels[labels == ROI]) for ROI in np.unique(labels)[1:]]
-        size_matrix = np.zeros(shape=np.repeat(len(np.unique(labels)[1:]),2))
-
-        for ROI1 in range(0,len(np.unique(labels)[1:])):
-            for ROI2 in range(0,len(np.unique(labels)[1:])):
-                size_matrix[ROI1, ROI2] = ROI_sizes[ROI1] + ROI_sizes[ROI2]
-
-        np.savetxt(base + '_' + str(self.inputs.threshold) + '_matrix_ROI_normalized.txt', matrix/size_matrix, delimiter='\t')
 
-        # Density matrix normalized by streamline length
-        length_matrix = np.zeros(shape=np.repeat(len(np.unique(labels)[1:]),2))
+        # Collecting (kind, scalar, threshold, matrix, text file) for every matrix
+        matrices = list()
+
+        # Threshold-independent matrices are computed once
+        density_matrix = connectome.density_matrix()
+        matrices.append(('median_length', '', None, connectome.median_length_matrix(),
+                         base + '_matrix_median_length.txt'))
+
+        thresholded = dict()
+        for threshold in self._thresholds():
+            # Constructing the streamlines matrix
+            matrix = density_matrix.copy()
+            matrix[matrix < threshold] = 0
+            thresholded[threshold] = matrix
+
+            matrices.append(('density', '', threshold, matrix,
+                             base + '_' + str(threshold) + '_matrix.txt'))
+
+            # Density matrix normalized by ROI size
+            matrices.append(('size_normalized', '', threshold, connectome.size_normalized_matrix(matrix),
+                             base + '_' + str(threshold) + '_matrix_ROI_normalized.txt'))
+
+            # Density matrix normalized by streamline length
+            matrices.append(('length_normalized', '', threshold, connectome.length_normalized_matrix(matrix),
+                             base + '_' + str(threshold) + '_matrix_length_normalized.txt'))
+
+        # Constructing the scalar matrices, all sharing the same streamline mapping
+        for scalar_file in self.inputs.scalar_file:
+            _, scalar_data = load_image(scalar_file)
+            scalar_matrix = connectome.scalar_matrix(scalar_data)
+            _, scalar_base, _ = split_filename(scalar_file)
+
+            for threshold in self._thresholds():
+                thresholded_scalar_matrix = scalar_matrix.copy()
+                thresholded_scalar_matrix[thresholded[threshold] == 0] = 0
+                matrices.append(('scalar', scalar_base.split('_')[-1], threshold, thresholded_scalar_matrix,
+                                 scalar_base + '_' + str(threshold) + '_matrix.txt'))
+
+        # Saving the matrices
+        if self.inputs.save_text:
+            for _, _, _, matrix, text_file in matrices:
+                np.savetxt(text_file, matrix, delimiter='\t')
+
+        if isdefined(self.inputs.cohort_store):
+            from additional_connectome import CohortConnectomeStore
+            store = CohortConnectomeStore(self.inputs.cohort_store)
+            store.append(self._subject_id(), self._atlas_name(),
+                         [(kind, scalar, threshold, matrix) for kind, scalar, threshold, matrix, _ in matrices],
+                         model=self.inputs.model)
 
-        for ROI1 in range(0,len(np.unique(labels)[1:])):
-            for ROI2 in range(0,len(np.unique(labels)[1:])):
-                length_matrix[ROI1, ROI2] = np.median(list(utils.length(mapping[ROI1, ROI2])))
-
-        length_matrix[np.tril_indices(n=len(length_matrix))] = 0
-        length_matrix = length_matrix.T + length_matrix - np.diagonal(length_matrix)
-
-        np.savetxt(base + '_' + str(self.inputs.threshold) + '_matrix_length_normalized.txt', matrix/length_matrix, delimiter='\t')
-
-        # Constructing the scalar matrix
-        dimensions = matrix.shape
-        scalar_matrix = np.empty(shape=dimensions)
+        return runtime
 
-        for i in range(0, dimensions[0]):
-            for j in range(0, dimensions[1]):
-                if matrix[i, j]:
-                    dm = utils.density_map(
-                        mapping[i, j], vol_dims=scalar_data.shape, affine=labels_img.affine)
-                    scalar_matrix[i, j] = np.mean(scalar_data[dm > 5])
-                else:
-                    scalar_matrix[i, j] = 0
+    def _thresholds(self):
+        if isdefined(self.inputs.thresholds) and self.inputs.thresholds:
+            return self.inputs.thresholds
+        return [self.inputs.threshold]
 
-        scalar_matrix[np.tril_indices(n=len(scalar_matrix))] = 0
-        scalar_matrix = scalar_matrix.T + scalar_matrix - np.diagonal(scalar_matrix)
+    def _subject_id(self):
+        from nipype.utils.filemanip import split_filename
+        if isdefined(self.inputs.subject_id):
+            return self.inputs.subject_id
+        return split_filename(self.inputs.track_file)[1]
 
-        # Saving the scalar matrix
+    def _atlas_name(self):
         from nipype.utils.filemanip import split_filename
-        _, base, _ = split_filename(self.inputs.scalar_file)
-        np.savetxt(base + '_matrix.txt', scalar_matrix, delimiter='\t')
-        return runtime
+        if isdefined(self.inputs.atlas_name):
+            return self.inputs.atlas_name
+        return split_filename(self.inputs.ROI_file)[1]
 
     def _list_outputs(self):
         from nipype.utils.filemanip import split_filename
         import os
         outputs = self._outputs().get()
-        _, base, _ = split_filename(self.inputs.scalar_file)
-        outputs["scalar_matrix"] = os.path.abspath(base + '_matrix.txt')
+        if not self.inputs.save_text:
+            return outputs
+        thresholds = [str(threshold) for threshold in self._thresholds()]
 
-        _, base, _ = split_filename(self.inputs.track_file)
-        outputs["density_matrix"] = os.path.abspath(base + '_' + str(self.inputs.threshold) + '_matrix.txt')
+        outputs["scalar_matrix"] = list()
+        for scalar_file in self.inputs.scalar_file:
+            _, base, _ = split_filename(scalar_file)
+            outputs["scalar_matrix"] += [os.path.abspath(base + '_' + threshold + '_matrix.txt') for threshold in thresholds]
 
-        outputs["length_normalized_matrix"] = os.path.abspath(base + '_' + str(self.inputs.threshold) + '_matrix_length_normalized.txt')
-        outputs["size_normalized_matrix"] = os.path.abspath(base + '_' + str(self.inputs.threshold) + '_matrix_ROI_normalized.txt')
+        _, base, _ = split_filename(self.inputs.track_file)
+        outputs["density_matrix"] = [os.path.abspath(base + '_' + threshold + '_matrix.txt') for threshold in thresholds]
+        outputs["length_normalized_matrix"] = [os.path.abspath(base + '_' + threshold + '_matrix_length_normalized.txt') for threshold in thresholds]
+        outputs["size_normalized_matrix"] = [os.path.abspath(base + '_' + threshold + '_matrix_ROI_normalized.txt') for threshold in thresholds]
+        outputs["median_length_matrix"] = os.path.abspath(base + '_matrix_median_length.txt')
         return outputs
 
 
@@ -460,11 +491,25 @@ class TractographyInputSpec(BaseInterfaceInputSpec):
     FA = File(exists=True, desc='FA map', mandatory=True)
     brain_mask = File(exists=True, desc='FA map', mandatory=True)
     model = traits.String(desc='model to use for reconstruction, either CSA, CSD')
+    n_jobs = traits.Int(1, usedefault=True, desc='number of processes used for model fitting and tracking')
+    seed_chunk_size = traits.Int(5000, usedefault=True, desc='number of seeds tracked per chunk')
+    random_seed = traits.Int(0, usedefault=True, desc='seed for probabilistic tracking, each chunk of seeds uses random_seed + chunk number')
+    model_cache = traits.String(desc='directory where fitted models are cached and reused across tracking runs')
+    hash_contents = traits.Bool(False, usedefault=True, desc='key the model cache on the contents of the input files instead of their path, size and modification time')
+    n_streamlines = traits.Int(desc='target number of streamlines, seeds are drawn at random in the white matter until it is reached')
+    time_budget = traits.Float(desc='wall-clock budget for tracking in seconds, seeds are drawn at random in the white matter until it is spent')
+    compression_error = traits.Float(desc='maximum deviation in mm of the saved streamlines from the tracked ones, nearly collinear points are removed before saving')
+    ROI_file = File(exists=True, desc='parcellation for the fused tracking-to-connectome mode, streamlines are assigned to its ROIs while they are tracked')
+    save_tractogram = traits.Bool(True, usedefault=True, desc='save the streamlines (.trk and tractogram container), can be turned off in the fused mode')
+    response_file = File(exists=True, desc='CSD response function, e.g. a group average from AverageResponse. Estimated from the data (and cached) if not given')
 
 class TractographyOutputSpec(TraitedSpec):
-    out_file = File(exists=True, desc="streamlines in NumPy format")
+    out_file = File(exists=True, desc="streamlines as a memory-mappable tractogram container (.sls)")
     out_track = File(exists=True, desc="tracks in Trackvis format")
+    density_map = File(exists=True, desc="number of streamlines passing through each voxel")
+    connectome_file = File(exists=True, desc="connectome accumulated during tracking, used as track file by CalcMatrix")
     GFA = File(exist=True, desc="Generalized fractional anisotropy image")
+    model = traits.String(desc="model used for tracking")
 
 class Tractography(BaseInterface):
     input_spec = TractographyInputSpec
@@ -472,21 +517,13 @@ class Tractography(BaseInterface):
 
     def _run_interface(self, runtime):
         import numpy as np
-        import nibabel as nib
         from dipy.core.gradients import gradient_table
         from nipype.utils.filemanip import split_filename
         from dipy.tracking.local_tracking import utils
         from dipy.reconst.shm import CsaOdfModel
         from dipy.data import default_sphere
-        from dipy.direction import peaks_from_model
         from dipy.tracking.stopping_criterion import ThresholdStoppingCriterion
         from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
-        from dipy.reconst.csdeconv import auto_response
-        from dipy.direction import DeterministicMaximumDirectionGetter
-        from dipy.tracking.local_tracking import LocalTracking
-        from dipy.io.streamline import save_tractogram
-        from dipy.tracking.streamline import Streamlines
-        from dipy.io.stateful_tractogram import Space, StatefulTractogram
 
 
         bvec = self.inputs.bvec
@@ -496,15 +533,20 @@ class Tractography(BaseInterface):
         mask_fname = self.inputs.brain_mask
         model = self.inputs.model
 
-        # Loading the data
-        img = nib.load(fname)
-        data = img.get_data()
+        # Loading the data, the DWI volume is only read when a model has to
+        # be fitted, and then only once
+        from additional_io import load_image
+        from additional_io import save_image
+        img, _ = load_image(fname, lazy=True)
+        dwi = dict()
 
-        FA_img = nib.load(FA_fname)
-        fa = FA_img.get_data()
+        def dwi_data():
+            if 'data' not in dwi:
+                dwi['data'] = np.asanyarray(img.dataobj)
+            return dwi['data']
 
-        mask_img = nib.load(mask_fname)
-        mask = mask_img.get_data()
+        FA_img, fa = load_image(FA_fname)
+        mask_img, mask = load_image(mask_fname)
 
         bval_fname = self.inputs.bval
         bvals = np.loadtxt(bval_fname)
@@ -521,54 +563,125 @@ class Tractography(BaseInterface):
 
         affine = np.eye(4)
 
-        # Creating a seed mask
-        seeds = utils.seeds_from_mask(white_matter, affine=affine, density=[1,1,1])
-
-        # Fitting the CSA model
-        csa_model = CsaOdfModel(gtab, sh_order=8)
-        csa_peaks = peaks_from_model(csa_model, data, default_sphere,
-                                     relative_peak_threshold=.8,
-                                     min_separation_angle=30,
-                                     mask=white_matter)
+        # Creating the seeds, either one per white matter voxel or drawn at
+        # random until the streamline count or time budget is met
+        random_seed = self.inputs.random_seed
+        budget = isdefined(self.inputs.n_streamlines) or isdefined(self.inputs.time_budget)
+        if budget:
+            from additional_tracking import random_seed_chunks
+            seeds = random_seed_chunks(white_matter, affine, self.inputs.seed_chunk_size, random_seed)
+        else:
+            seeds = utils.seeds_from_mask(white_matter, affine=affine, density=[1,1,1])
+
+        # Fitted models are reused from the cache for the same data and fit parameters
+        from additional_tracking import ReconstructionCache, cached_fit, peaks_from_arrays
+        from additional_tracking import csa_peaks_in_blocks, csd_shm_in_blocks
+        # The DWI digest alone keys the response, as in ResponseFunction
+        if isdefined(self.inputs.model_cache):
+            cache = ReconstructionCache(self.inputs.model_cache)
+            dwi_digest = cache.digest([fname, bval, bvec], contents=self.inputs.hash_contents)
+            data_digest = cache.digest([FA_fname, mask_fname], contents=self.inputs.hash_contents, base=dwi_digest)
+        else:
+            cache, dwi_digest, data_digest = None, None, None
+
+        # Fitting the CSA model in parallel blocks of voxels
+        def fit_csa():
+            csa_model = CsaOdfModel(gtab, sh_order=8)
+            return csa_peaks_in_blocks(csa_model, dwi_data(), default_sphere, white_matter,
+                                       n_jobs=self.inputs.n_jobs,
+                                       relative_peak_threshold=.8,
+                                       min_separation_angle=30)
+
+        csa_peaks = peaks_from_arrays(
+            cached_fit(cache, data_digest, 'csa', fit_csa, sh_order=8, relative_peak_threshold=.8,
+                       min_separation_angle=30, white_matter_fa=.2),
+            default_sphere)
         classifier = ThresholdStoppingCriterion(csa_peaks.gfa, .1)
 
+        from additional_tracking import track_in_chunks
+
         if model == 'CSA':
-            streamlines = LocalTracking(csa_peaks, classifier, seeds, np.eye(4), step_size=.5)
+            streamlines = track_in_chunks(csa_peaks, classifier, seeds, np.eye(4),
+                                          n_jobs=self.inputs.n_jobs, chunk_size=self.inputs.seed_chunk_size,
+                                          random_seed=random_seed, step_size=.5)
 
         if model == 'CSD':
             # CSD model
-            from dipy.reconst.csdeconv import auto_response
-            from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
             from dipy.direction import ProbabilisticDirectionGetter
 
 
-            response, ratio = auto_response(gtab, data, roi_radius=10, fa_thr=0.7)
-            csd_model = ConstrainedSphericalDeconvModel(gtab, response, sh_order=8)
-            csd_fit = csd_model.fit(data, mask=white_matter)
+            from additional_tracking import estimate_response, load_response
+
+            # Response function, either given (e.g. a group average) or
+            # estimated once per subject and shared with ResponseFunction
+            if isdefined(self.inputs.response_file):
+                response = load_response(self.inputs.response_file)
+            else:
+                estimated = cached_fit(cache, dwi_digest, 'response',
+                                       lambda: estimate_response(gtab, dwi_data(), roi_radius=10, fa_thr=.7),
+                                       roi_radius=10, fa_thr=.7)
+                response = (estimated['response_evals'], float(estimated['response_S0']))
 
-            prob_dg = ProbabilisticDirectionGetter.from_shcoeff(csd_fit.shm_coeff, max_angle=45., sphere=default_sphere)
+            def fit_csd():
+                csd_model = ConstrainedSphericalDeconvModel(gtab, response, sh_order=8)
+                return dict(shm_coeff=csd_shm_in_blocks(csd_model, dwi_data(), white_matter,
+                                                        n_jobs=self.inputs.n_jobs))
+
+            csd = cached_fit(cache, data_digest, 'csd', fit_csd, sh_order=8,
+                             response=np.append(*response).tolist(), white_matter_fa=.2)
+
+            prob_dg = ProbabilisticDirectionGetter.from_shcoeff(csd['shm_coeff'], max_angle=45., sphere=default_sphere)
 
             # Tracking
-            streamlines = LocalTracking(prob_dg, classifier, seeds, affine,step_size=.5, max_cross=2)
+            streamlines = track_in_chunks(prob_dg, classifier, seeds, affine,
+                                          n_jobs=self.inputs.n_jobs, chunk_size=self.inputs.seed_chunk_size,
+                                          random_seed=random_seed, step_size=.5, max_cross=2)
 
-        # Compute streamlines and store as a list.
-        streamlines = Streamlines(streamlines)
+        if budget:
+            from additional_tracking import limit_streamlines
+            streamlines = limit_streamlines(
+                streamlines,
+                self.inputs.n_streamlines if isdefined(self.inputs.n_streamlines) else None,
+                self.inputs.time_budget if isdefined(self.inputs.time_budget) else None)
 
-        # Saving the tracks in NumPy format
         _, base, _ = split_filename(fname)
-        np.save(base + '_' + self.inputs.model + '.npy', np.array(streamlines, dtype=np.object))
 
         # Saving the GFA image
-        nib.save(nib.Nifti1Image(csa_peaks.gfa, FA_img.affine), base + '_GFA.nii.gz')
+        save_image(csa_peaks.gfa, FA_img.affine, base + '_GFA.nii.gz')
+
+        # In the fused mode the streamlines are assigned to the ROIs while
+        # they are tracked, at full resolution
+        if isdefined(self.inputs.ROI_file):
+            from additional_connectome import StreamingConnectome
+            ROI_img, ROI = load_image(self.inputs.ROI_file)
+            connectome = StreamingConnectome(ROI, ROI_img.affine,
+                                             streamline_affine=FA_img.affine)
+            streamlines = connectome.accumulate(streamlines)
+
+        # Save streamlines in Trackvis format and in a tractogram container
+        # while they are tracked, building the density map in the same pass.
+        # Streamlines are compressed after the density map is updated.
+        from additional_connectome import TractogramContainerWriter
+        from additional_tracking import StreamingTractogramWriter
+        tol_error = self.inputs.compression_error if isdefined(self.inputs.compression_error) else None
+
+        if self.inputs.save_tractogram:
+            container = TractogramContainerWriter(base + '_' + self.inputs.model + '.sls',
+                                                  FA_img.affine, FA_img.shape, tol_error=tol_error)
+            writer = StreamingTractogramWriter(FA_img, tol_error=tol_error, container=container)
+            with container:
+                writer.write_trk(streamlines, base + '_' + self.inputs.model + '.trk')
+        else:
+            writer = StreamingTractogramWriter(FA_img)
+            for _ in writer.process(streamlines):
+                pass
+
+        if isdefined(self.inputs.ROI_file):
+            connectome.save(base + '_' + self.inputs.model + '.npz')
 
         # Saving the image for visualization in TrackVis
-        dm = utils.density_map(streamlines, affine, fa.shape)
-        dm_img = nib.Nifti1Image(dm.astype("int16"), FA_img.affine)
-
-        # Save streamlines in Trackvis format
-        streamlines_trk = Streamlines(streamlines)
-        sft = StatefulTractogram(streamlines_trk, dm_img, Space.VOX)
-        save_tractogram(sft, base + '_' + self.inputs.model + '.trk')
+        save_image(writer.density_map().astype('int32'), FA_img.affine,
+                   base + '_' + self.inputs.model + '_density.nii.gz')
 
         return runtime
 
@@ -579,112 +692,103 @@ class Tractography(BaseInterface):
         outputs = self._outputs().get()
         fname = self.inputs.in_file
         _, base, _ = split_filename(fname)
-        outputs["out_file"] = os.path.abspath(base + '_' + self.inputs.model + '.npy')
-        outputs["out_track"] = os.path.abspath(base + '_' + self.inputs.model +'.trk')
+        if self.inputs.save_tractogram:
+            outputs["out_file"] = os.path.abspath(base + '_' + self.inputs.model + '.sls')
+            outputs["out_track"] = os.path.abspath(base + '_' + self.inputs.model +'.trk')
+        if isdefined(self.inputs.ROI_file):
+            outputs["connectome_file"] = os.path.abspath(base + '_' + self.inputs.model + '.npz')
+        outputs["density_map"] = os.path.abspath(base + '_' + self.inputs.model + '_density.nii.gz')
         outputs["GFA"] = os.path.abspath(base + '_GFA.nii.gz')
+        outputs["model"] = self.inputs.model
         return outputs
 
 # ==================================================================
-"""
-Expand parcels
-This function expands the parcellation labels into the white matter
-"""
+# CSD response functions
 
-class ExpandParcelsInputSpec(BaseInterfaceInputSpec):
-    dilatationVoxel = traits.Int(0, desc='Number of voxels to dilate the parcellation by', mandatory=True)
-    parcellation_name = traits.String(
-        desc='parcellation name', mandatory=True)
-    parcellation_file = File(
-        exists=True, desc='volume parcellation file', mandatory=True)
-    subjects_dir = traits.String(
-        desc='FreeSurfer subjects directory', mandatory=True)
-    subject_id = traits.String(desc='subject ID', mandatory=True)
-    white_matter_image = File(exists=True, desc='white matter image', mandatory=True)
+class ResponseFunctionInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, desc='diffusion weighted volume', mandatory=True)
+    bval = File(exists=True, desc='FSL-style b-value file', mandatory=True)
+    bvec = File(exists=True, desc='FSL-style b-vector file', mandatory=True)
+    roi_radius = traits.Int(10, usedefault=True, desc='radius of the central cube used to find single-fibre voxels')
+    fa_thr = traits.Float(.7, usedefault=True, desc='FA threshold of single-fibre voxels')
+    model_cache = traits.String(desc='directory where responses are cached, shared with Tractography')
+    hash_contents = traits.Bool(False, usedefault=True, desc='key the cache on the contents of the input files instead of their path, size and modification time')
 
-class ExpandParcelsOutputSpec(TraitedSpec):
-    out_file = File(desc="dilated parcellation image")
-    subject_id = traits.String(desc='FreeSurfer subject ID')
+class ResponseFunctionOutputSpec(TraitedSpec):
+    response_file = File(exists=True, desc='response function (eigenvalues and S0)')
 
-class ExpandParcels(BaseInterface):
-    input_spec = ExpandParcelsInputSpec
-    output_spec = ExpandParcelsOutputSpec
+class ResponseFunction(BaseInterface):
+    input_spec = ResponseFunctionInputSpec
+    output_spec = ResponseFunctionOutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
         import numpy as np
-        from nipype.utils.filemanip import split_filename
-
-        parcellation_file = self.inputs.parcellation_file
-        white_matter_image = self.inputs.white_matter_image
-        dilatationVoxel = self.inputs.dilatationVoxel
-        parcellation_name = self.inputs.parcellation_name
+        from dipy.core.gradients import gradient_table
+        from additional_io import load_image
+        from additional_tracking import ReconstructionCache, cached_fit
+        from additional_tracking import estimate_response, save_response
 
-        volGM = nib.load(parcellation_file).get_data()
-        affine = nib.load(parcellation_file).affine
-        volWM = nib.load(white_matter_image).get_data()
-        wmCode = [2,41];
-
-        # Selecting cortical areas
-        newVol = volGM.copy()
-        parcelSetlh = np.asarray(np.where(volGM == wmCode[0]))
-        parcelSetrh = np.asarray(np.where(volGM == wmCode[1]))
-        parcelWhite = np.hstack([parcelSetlh, parcelSetrh])
-
-        parcelSet = np.unique(volGM);
-        parcelSet = parcelSet[parcelSet > 1000]
-
-        # Calculating the parcel centroids
-        centroids = list()
-        for parcel in parcelSet:
-            ci,cj,ck = np.where(newVol == parcel)
-            centroids.append([np.mean(ci), np.mean(cj), np.mean(ck)])
-
-        centroids = np.asarray(centroids)
-
-        for nv in range(0, np.shape(parcelWhite)[1]):
-            ci,cj,ck = parcelWhite[..., nv]
-            candidates = list()
-
-            for ni in range(-dilatationVoxel, dilatationVoxel + 1):
-                for nj in range(-dilatationVoxel, dilatationVoxel + 1):
-                    for nk in range(-dilatationVoxel, dilatationVoxel + 1):
-                        nci = ci + ni
-                        ncj = cj + nj
-                        nck = ck + nk
-                        if (nci>0) & (nci<257) & (ncj>0) & (ncj<257) & (nck>0) & (nck<257):
-                            if volGM[nci, ncj, nck] > 1000:
-                                candidates.append(volGM[nci, ncj, nck])
-
-
-            candidates = np.unique(candidates).transpose()
-            distances = list()
-
-            for nc in range(0, np.shape(candidates)[0]):
-                candPos = np.where(parcelSet == candidates[nc])
-                distances.append([((centroids[candPos, 0] - ci)**2)[0][0],
-                 ((centroids[candPos, 1] - ci)**2)[0][0],
-                  ((centroids[candPos, 2] - ci)**2)[0][0]])
-
-            if distances:
-                newVol[ci, cj, ck] = candidates[np.where(distances == np.min(distances))[0]]
-            else:
-                newVol[ci, cj, ck] = volGM[ci, cj, ck]
+        bvals = np.loadtxt(self.inputs.bval)
+        bvecs = np.loadtxt(self.inputs.bvec)
+        bvecs = np.vstack([bvecs[0,:],bvecs[1,:],bvecs[2,:]]).T
+        gtab = gradient_table(bvals, bvecs)
 
-        path_subj = self.inputs.subjects_dir + self.inputs.subject_id
-        nib.save(nib.Nifti1Image(newVol, affine),
-                 self.inputs.subjects_dir + self.inputs.subject_id + '/parcellation/' + self.inputs.parcellation_name  + '_expanded.nii.gz')
+        if isdefined(self.inputs.model_cache):
+            cache = ReconstructionCache(self.inputs.model_cache)
+            data_digest = cache.digest([self.inputs.in_file, self.inputs.bval, self.inputs.bvec],
+                                       contents=self.inputs.hash_contents)
+        else:
+            cache, data_digest = None, None
+
+        roi_radius = self.inputs.roi_radius
+        fa_thr = self.inputs.fa_thr
+        response = cached_fit(cache, data_digest, 'response',
+                              lambda: estimate_response(gtab, load_image(self.inputs.in_file)[1],
+                                                        roi_radius=roi_radius, fa_thr=fa_thr),
+                              roi_radius=roi_radius, fa_thr=fa_thr)
+        save_response(self._out_file(), response['response_evals'], response['response_S0'])
 
         return runtime
 
-    def _list_outputs(self):
+    def _out_file(self):
         from nipype.utils.filemanip import split_filename
         import os
+        _, base, _ = split_filename(self.inputs.in_file)
+        return os.path.abspath(base + '_response.txt')
+
+    def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs["out_file"] = os.path.abspath(self.inputs.subjects_dir + self.inputs.subject_id + '/parcellation/' + self.inputs.parcellation_name  + '_expanded.nii.gz')
-        outputs["subject_id"] = self.inputs.subject_id
+        outputs['response_file'] = self._out_file()
         return outputs
 
 
+class AverageResponseInputSpec(BaseInterfaceInputSpec):
+    response_files = InputMultiPath(File(exists=True), desc='subject response functions', mandatory=True)
+    out_file = File('group_response.txt', usedefault=True, desc='group-average response function')
+
+class AverageResponseOutputSpec(TraitedSpec):
+    response_file = File(exists=True, desc='group-average response function (eigenvalues and S0)')
+
+class AverageResponse(BaseInterface):
+    input_spec = AverageResponseInputSpec
+    output_spec = AverageResponseOutputSpec
+
+    def _run_interface(self, runtime):
+        from additional_tracking import average_response, save_response
+
+        evals, S0 = average_response(self.inputs.response_files)
+        save_response(self._out_file(), evals, S0)
+
+        return runtime
+
+    def _out_file(self):
+        import os
+        return os.path.abspath(self.inputs.out_file)
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['response_file'] = self._out_file()
+        return outputs
 
 # ==================================================================
 """
@@ -696,6 +800,12 @@ http://nipy.org/dipy/examples_built/denoise_nlmeans.html#example-denoise-nlmeans
 class DipyDenoiseInputSpec(BaseInterfaceInputSpec):
     in_file = File(
         exists=True, desc='diffusion weighted volume for denoising', mandatory=True)
+    n_jobs = traits.Int(1, usedefault=True, desc='number of processes, volumes are denoised in parallel')
+    out_of_core = traits.Bool(False, usedefault=True, desc='read one volume at a time (from an uncompressed copy of a .nii.gz input) and write the denoised volumes to an on-disk memory map')
+    out_dtype = traits.Enum('float32', 'input', usedefault=True, desc='data type of the out-of-core output, float32 or the input data type')
+    method = traits.Enum('nlmeans', 'nlmeans_blockwise', 'mppca', usedefault=True, desc='denoiser: classic or blockwise non-local means per volume, or local PCA (Marchenko-Pastur) over all volumes jointly, which reads the whole image')
+    patch_radius = traits.Int(desc='patch radius, defaults to 1 for non-local means and 2 for mppca')
+    block_radius = traits.Int(5, usedefault=True, desc='search block radius of non-local means')
 
 
 class DipyDenoiseOutputSpec(TraitedSpec):
@@ -707,30 +817,61 @@ class DipyDenoise(BaseInterface):
     output_spec = DipyDenoiseOutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
         import numpy as np
-        from dipy.denoise.nlmeans import nlmeans
+        from nipype import logging
         from nipype.utils.filemanip import split_filename
+        from additional_denoise import denoise_jointly, denoise_volumes, JOINT_DENOISERS
+        from additional_io import load_image
+        from additional_io import save_image
 
         fname = self.inputs.in_file
-        img = nib.load(fname)
-        data = img.get_data()
-        affine = img.get_affine()
-        mask = data[..., 0] > 80
-        a = data.shape
-
-        denoised_data = np.ndarray(shape=data.shape)
-        for image in range(0, a[3]):
-            print(str(image + 1) + '/' + str(a[3] + 1))
-            dat = data[..., image]
-            # Calculating the standard deviation of the noise
-            sigma = np.std(dat[~mask])
-            den = nlmeans(dat, sigma=sigma, mask=mask)
-            denoised_data[:, :, :, image] = den
-
         _, base, _ = split_filename(fname)
-        nib.save(nib.Nifti1Image(denoised_data, affine),
-                 base + '_denoised.nii.gz')
+        input_copy = None
+        if self.inputs.out_of_core and fname.endswith('.gz'):
+            # Volumes are read from an uncompressed copy, as slicing the
+            # compressed file decompresses it again for every volume
+            from additional_io import decompress_image
+            input_copy = decompress_image(fname, base + '_input.nii')
+        img, data = load_image(input_copy or fname, lazy=self.inputs.out_of_core)
+        affine = img.affine
+
+        if self.inputs.out_of_core:
+            # Volumes are read from the file one at a time and written to a
+            # memory map on disk
+            from additional_denoise import volume_memmap
+            mask = np.asarray(data[..., 0]) > 80
+            dtype = img.get_data_dtype() if self.inputs.out_dtype == 'input' else np.float32
+            denoised_data = volume_memmap(base + '_denoised.dat', img.shape, dtype)
+        else:
+            mask = data[..., 0] > 80
+            denoised_data = None
+
+        if self.inputs.method in JOINT_DENOISERS:
+            # All volumes are denoised together
+            patch_radius = self.inputs.patch_radius if isdefined(self.inputs.patch_radius) else 2
+            denoised = denoise_jointly(np.asarray(data, dtype=np.float32), mask, self.inputs.method,
+                                       patch_radius=patch_radius)
+            if denoised_data is None:
+                denoised_data = denoised
+            else:
+                denoised_data[:] = denoised
+            del denoised
+        else:
+            # Volumes are denoised independently, in parallel with n_jobs
+            patch_radius = self.inputs.patch_radius if isdefined(self.inputs.patch_radius) else 1
+            denoised_data = denoise_volumes(data, mask, out=denoised_data, n_jobs=self.inputs.n_jobs,
+                                            logger=logging.getLogger('nipype.interface'),
+                                            method=self.inputs.method, patch_radius=patch_radius,
+                                            block_radius=self.inputs.block_radius)
+
+        save_image(denoised_data, affine, base + '_denoised.nii.gz')
+
+        if self.inputs.out_of_core:
+            import os
+            del denoised_data, data, img
+            os.remove(base + '_denoised.dat')
+            if input_copy is not None:
+                os.remove(input_copy)
 
         return runtime
 
@@ -755,6 +896,11 @@ http://nipy.org/dipy/examples_built/denoise_nlmeans.html#example-denoise-nlmeans
 class DipyDenoiseT1InputSpec(BaseInterfaceInputSpec):
     in_file = File(
         exists=True, desc='diffusion weighted volume for denoising', mandatory=True)
+    method = traits.Enum('nlmeans', 'nlmeans_blockwise', usedefault=True, desc='denoiser: classic or blockwise non-local means')
+    patch_radius = traits.Int(1, usedefault=True, desc='patch radius of non-local means')
+    block_radius = traits.Int(5, usedefault=True, desc='search block radius of non-local means')
+    n_jobs = traits.Int(1, usedefault=True, desc='number of processes, the volume is denoised in tiles in parallel if more than 1')
+    tile_size = traits.Int(64, usedefault=True, desc='edge length in voxels of the tiles used in parallel')
 
 
 class DipyDenoiseT1OutputSpec(TraitedSpec):
@@ -766,24 +912,33 @@ class DipyDenoiseT1(BaseInterface):
     output_spec = DipyDenoiseT1OutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
         import numpy as np
-        from dipy.denoise.nlmeans import nlmeans
         from nipype.utils.filemanip import split_filename
+        from additional_denoise import denoise_volume
+        from additional_io import load_image
+        from additional_io import save_image
 
         fname = self.inputs.in_file
-        img = nib.load(fname)
-        data = img.get_data()
-        affine = img.get_affine()
+        img, data = load_image(fname)
+        affine = img.affine
         mask = data > 20
 
         # Calculating the standard deviation of the noise
         sigma = np.std(data[~mask])
-        denoised_data = nlmeans(data, sigma=sigma, mask=mask)
+        if self.inputs.n_jobs > 1:
+            # Tiles with halos give the same result as the whole volume
+            from additional_denoise import denoise_tiled
+            denoised_data = denoise_tiled(data, sigma, mask, tile_size=self.inputs.tile_size,
+                                          n_jobs=self.inputs.n_jobs, method=self.inputs.method,
+                                          patch_radius=self.inputs.patch_radius,
+                                          block_radius=self.inputs.block_radius)
+        else:
+            denoised_data = denoise_volume(data, sigma, mask, self.inputs.method,
+                                           patch_radius=self.inputs.patch_radius,
+                                           block_radius=self.inputs.block_radius)
 
         _, base, _ = split_filename(fname)
-        nib.save(nib.Nifti1Image(denoised_data, affine),
-                 base + '_denoised.nii')
+        save_image(denoised_data, affine, base + '_denoised.nii')
 
         return runtime
 
@@ -812,9 +967,11 @@ class ExpandParcelsInputSpec(BaseInterfaceInputSpec):
         desc='FreeSurfer subjects directory', mandatory=True)
     subject_id = traits.String(desc='subject ID', mandatory=True)
     white_matter_image = File(exists=True, desc='white matter image', mandatory=True)
+    radii = traits.List(traits.Int, desc='additional dilatation radii, expanded in the same pass')
 
 class ExpandParcelsOutputSpec(TraitedSpec):
     out_file = File(desc="dilated parcellation image")
+    expanded_radii = OutputMultiPath(File(), desc="parcellation images dilated by each of the radii")
     subject_id = traits.String(desc='FreeSurfer subject ID')
 
 class ExpandParcels(BaseInterface):
@@ -822,77 +979,39 @@ class ExpandParcels(BaseInterface):
     output_spec = ExpandParcelsOutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
-        import numpy as np
-        from nipype.utils.filemanip import split_filename
+        from additional_io import load_image
+        from additional_io import save_image
+        from additional_parcellation import expand_parcels_radii
 
         parcellation_file = self.inputs.parcellation_file
-        white_matter_image = self.inputs.white_matter_image
         dilatationVoxel = self.inputs.dilatationVoxel
-        parcellation_name = self.inputs.parcellation_name
+        radii = self.inputs.radii if isdefined(self.inputs.radii) else []
 
-        volGM = nib.load(parcellation_file).get_data()
-        affine = nib.load(parcellation_file).affine
-        volWM = nib.load(white_matter_image).get_data()
-        wmCode = [2,41];
-
-        # Selecting cortical areas
-        newVol = volGM.copy()
-        parcelSetlh = np.asarray(np.where(volGM == wmCode[0]))
-        parcelSetrh = np.asarray(np.where(volGM == wmCode[1]))
-        parcelWhite = np.hstack([parcelSetlh, parcelSetrh])
-
-        parcelSet = np.unique(volGM);
-        parcelSet = parcelSet[parcelSet > 1000]
-
-        # Calculating the parcel centroids
-        centroids = list()
-        for parcel in parcelSet:
-            ci,cj,ck = np.where(newVol == parcel)
-            centroids.append([np.mean(ci), np.mean(cj), np.mean(ck)])
-
-        centroids = np.asarray(centroids)
-
-        for nv in range(0, np.shape(parcelWhite)[1]):
-            ci,cj,ck = parcelWhite[..., nv]
-            candidates = list()
-
-            for ni in range(-dilatationVoxel, dilatationVoxel + 1):
-                for nj in range(-dilatationVoxel, dilatationVoxel + 1):
-                    for nk in range(-dilatationVoxel, dilatationVoxel + 1):
-                        nci = ci + ni
-                        ncj = cj + nj
-                        nck = ck + nk
-                        if (nci>0) & (nci<257) & (ncj>0) & (ncj<257) & (nck>0) & (nck<257):
-                            if volGM[nci, ncj, nck] > 1000:
-                                candidates.append(volGM[nci, ncj, nck])
-
-
-            candidates = np.unique(candidates).transpose()
-            distances = list()
-
-            for nc in range(0, np.shape(candidates)[0]):
-                candPos = np.where(parcelSet == candidates[nc])
-                distances.append([((centroids[candPos, 0] - ci)**2)[0][0],
-                 ((centroids[candPos, 1] - ci)**2)[0][0],
-                  ((centroids[candPos, 2] - ci)**2)[0][0]])
-
-            if distances:
-                newVol[ci, cj, ck] = candidates[np.where(distances == np.min(distances))[0]]
-            else:
-                newVol[ci, cj, ck] = volGM[ci, cj, ck]
+        img, volGM = load_image(parcellation_file)
+        affine = img.affine
 
-        path_subj = self.inputs.subjects_dir + self.inputs.subject_id
-        nib.save(nib.Nifti1Image(newVol, affine),
-                 self.inputs.subjects_dir + '/' + self.inputs.subject_id + '/parcellation/' + self.inputs.parcellation_name  + '_expanded.nii.gz')
+        # Expanding the cortical parcels into the white matter, for all
+        # radii in one pass
+        for radius, newVol in expand_parcels_radii(volGM, radii + [dilatationVoxel]):
+            if radius == dilatationVoxel:
+                save_image(newVol, affine, self._expanded_file())
+            if radius in radii:
+                save_image(newVol, affine, self._expanded_file(radius))
 
         return runtime
 
+    def _expanded_file(self, radius=None):
+        import os
+        suffix = '_expanded.nii.gz' if radius is None else '_expanded_r%d.nii.gz' % radius
+        return os.path.abspath(self.inputs.subjects_dir + '/' + self.inputs.subject_id + '/parcellation/' + self.inputs.parcellation_name + suffix)
+
     def _list_outputs(self):
         from nipype.utils.filemanip import split_filename
         import os
         outputs = self._outputs().get()
-        outputs["out_file"] = os.path.abspath(self.inputs.subjects_dir + '/' +self.inputs.subject_id + '/parcellation/' + self.inputs.parcellation_name  + '_expanded.nii.gz')
+        outputs["out_file"] = self._expanded_file()
+        if isdefined(self.inputs.radii):
+            outputs["expanded_radii"] = [self._expanded_file(radius) for radius in self.inputs.radii]
         outputs["subject_id"] = self.inputs.subject_id
         return outputs
 
@@ -914,18 +1033,20 @@ class Extractb0(BaseInterface):
     output_spec = Extractb0OutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
-        img = nib.load(self.inputs.in_file)
-        data = img.get_data()
-        affine = img.get_affine()
+        import numpy as np
+        from additional_io import load_image
+        from additional_io import save_image
+
+        # Only the first volume is read
+        img, data = load_image(self.inputs.in_file, lazy=True)
+        affine = img.affine
 
         from nipype.utils.filemanip import split_filename
         import os
         outputs = self._outputs().get()
         fname = self.inputs.in_file
         _, base, _ = split_filename(fname)
-        nib.save(nib.Nifti1Image(data[..., 0], affine),
-                 os.path.abspath(base + '_b0.nii.gz'))
+        save_image(np.asarray(data[..., 0]), affine, os.path.abspath(base + '_b0.nii.gz'))
         return runtime
 
     def _list_outputs(self):
@@ -987,6 +1108,12 @@ class FSRename(BaseInterface):
 Renumber parcels
 This function renumbers the parcels and creates maps for cortical and subcortical parcellation
 """
+# Names of the derived parcellations, also validated by SubjectSpaceParcellation
+DERIVED_OUTPUT = traits.Enum('cortical', 'cortical_consecutive', 'cortical_expanded', 'cortical_expanded_consecutive',
+                             'leftHemisphere', 'leftHemisphere_expanded', 'renum_subMask', 'renum_subMask_expanded',
+                             'rightHemisphere', 'rightHemisphere_expanded', 'subcortical', 'subcortical_expanded',
+                             'whiteMatter', 'whiteMatter_expanded', 'aparc', 'aparc_subMask')
+
 class ReunumberParcelsInputSpec(BaseInterfaceInputSpec):
     subjects_dir = traits.String(
         desc='FreeSurfer subject directory generated by recon-all', mandatory=True)
@@ -994,6 +1121,10 @@ class ReunumberParcelsInputSpec(BaseInterfaceInputSpec):
         desc='subject ID', mandatory=True)
     parcellation_name = traits.String(
         desc='parcellation name', mandatory=True)
+    derived_outputs = traits.List(
+        DERIVED_OUTPUT, [], usedefault=True,
+        desc='derived parcellations to write, besides the original and renumbered parcellations and the boundaries')
+    radii = traits.List(traits.Int, desc='additional dilatation radii of ExpandParcels, whose parcellations are renumbered too')
 
 class ReunumberParcelsOutputSpec(TraitedSpec):
     cortical = File(exists=True, desc="cortical parcellation")
@@ -1005,7 +1136,9 @@ class ReunumberParcelsOutputSpec(TraitedSpec):
     orig = File(exists=True, desc="original parcellation image")
     renum = File(exists=True, desc="renumbered parcellation")
     renum_expanded = File(exists=True, desc="renumbered parcellation expanded into WM")
+    renum_expanded_radii = OutputMultiPath(File(exists=True), desc="renumbered parcellations expanded into WM by each of the radii")
     renum_subMask = File(exists=True, desc="renumbered parcellation with subcortical regions masked out")
+    renum_subMask_expanded = File(exists=True, desc="renumbered parcellation expanded into WM with subcortical regions masked out")
     rightHemisphere = File(exists=True, desc="parcellation of the right hemisphere")
     rightHemisphere_expanded = File(exists=True, desc="parcellation of the right hemisphere expanded into WM")
     subcortical = File(exists=True, desc="parcellation of subcortical regions")
@@ -1022,43 +1155,36 @@ class ReunumberParcels(BaseInterface):
     output_spec = ReunumberParcelsOutputSpec
 
     def _run_interface(self, runtime):
-        import nibabel as nib
         import numpy as np
         import os
         from subprocess import call
+        from additional_io import load_image
+        from additional_io import save_image
+        from additional_parcellation import consecutive_labels
+        from additional_parcellation import derived_labels
+        from additional_parcellation import label_index
+        from additional_parcellation import PARCELLATION_VARIANTS
+        from additional_parcellation import renumber_labels
+        from additional_parcellation import replace_labels
 
         wmpar1 = 1
         wmpar2 = 20
+        merged_labels = {72: 31, 80: 0, 29: 0}
         path_subj = self.inputs.subjects_dir + '/' + self.inputs.subject_id + '/'
         parcellation_name = self.inputs.parcellation_name
 
-        vol = nib.load(path_subj + 'parcellation/' +
-                       parcellation_name + '.nii.gz').get_data()
-        affine = nib.load(path_subj + 'parcellation/' +
-                          parcellation_name + '.nii.gz').affine
-        nib.save(nib.Nifti1Image(vol, affine), path_subj +
-                 'parcellation/' + parcellation_name + '_orig.nii.gz')
-
-        vol[vol == 72] = 31
-        vol[vol == 80] = 0
-        vol[vol == 29] = 0
-        nib.save(nib.Nifti1Image(vol, affine), path_subj +
-                 'parcellation/' + parcellation_name + '.nii.gz')
-
-        volRenum = np.zeros(shape=vol.shape)
-        volRenum_exp = np.zeros(shape=vol.shape)
-        parcels = np.unique(vol)
+        img, vol = load_image(path_subj + 'parcellation/' + parcellation_name + '.nii.gz')
+        save_image(vol, img.affine, path_subj + 'parcellation/' + parcellation_name + '_orig.nii.gz')
+
+        parcels = np.unique(replace_labels(np.unique(vol), merged_labels))
         parcels_sub = parcels[parcels < 1000]
 
         if len(parcels_sub) < 42:
-            pos_OpticChiasm = np.where(vol == 85)
-            vol[pos_OpticChiasm[0], pos_OpticChiasm[1], pos_OpticChiasm[2]] = 77
-            parcels = np.unique(vol)
+            parcels = np.unique(replace_labels(parcels, {85: 77}))
             parcels_sub = parcels[parcels < 1000]
             if len(parcels_sub) < 42:
                 print('Less subcortical regions than expected')
 
-        numParcels = parcels.shape[0]
         limitSub_array = np.where(parcels < 1001)[0]
         limitSub = limitSub_array[-1]
         call('echo ' + str(limitSub) + ' >' + path_subj +
@@ -1069,135 +1195,65 @@ class ReunumberParcels(BaseInterface):
         call('echo ' + str(limitHemi) + ' >' + path_subj +
              'parcellation/boundary_lh_rh.txt', shell=True)
 
-        for type in ['_expanded', '']:
-            vol = nib.load(path_subj + 'parcellation/' +
-                           parcellation_name + type + '.nii.gz').get_data()
-            affine = nib.load(path_subj + 'parcellation/' +
-                              parcellation_name + type + '.nii.gz').affine
-
-            vol[vol == 72] = 31
-            vol[vol == 80] = 0
-            vol[vol == 29] = 0
-            nib.save(nib.Nifti1Image(vol, affine), path_subj +
-                     'parcellation/' + parcellation_name + type + '.nii.gz')
-
-            for i in range(1, numParcels):
-                voxParcel = np.where(vol == parcels[i])
-                volRenum[voxParcel[0], voxParcel[1], voxParcel[2]] = i
-
-            nib.save(nib.Nifti1Image(volRenum, affine), path_subj +
-                     'parcellation/' + parcellation_name + '_renum' + type + '.nii.gz')
-
-            # Renum start in 1
-            vol_Renumst = volRenum.copy()
-            vol_Renumst = vol_Renumst - limitSub
-            vol_Renumst[vol_Renumst < 0] = 0
-            nib.save(nib.Nifti1Image(vol_Renumst, affine), path_subj + 'parcellation/' +
-                     parcellation_name + '_cortical' + type + '_consecutive.nii.gz')
-
-            # Renum parts
-            vol = volRenum.copy()
-
-            # Subcortical
-            newVol = vol.copy()
-            newVol[newVol > limitSub] = 0
-            newVol[newVol == wmpar1] = 0
-            newVol[newVol == wmpar2] = 0
-            nib.save(nib.Nifti1Image(newVol, affine), path_subj + 'parcellation/' +
-                     parcellation_name + '_subcortical' + type + '.nii.gz')
-
-            # Cortical
-            newVol = vol.copy()
-            newVol[newVol < limitSub + 1] = 0
-            newVol[newVol == wmpar1] = 0
-            newVol[newVol == wmpar2] = 0
-            nib.save(nib.Nifti1Image(newVol, affine), path_subj +
-                     'parcellation/' + parcellation_name + '_cortical' + type + '.nii.gz')
-
-            # Cortical start in 1
-            newVol = vol.copy()
-            newVol[newVol < limitSub + 1] = 0
-            newVol[newVol == wmpar1] = 0
-            newVol[newVol == wmpar2] = 0
-            newVol = newVol - limitSub
-            newVol[newVol < 0] = 0
-            nib.save(nib.Nifti1Image(newVol, affine), path_subj + 'parcellation/' +
-                     parcellation_name + '_cortical' + type + '_consecutive.nii.gz')
-
-            # Left
-            newVol = vol.copy()
-            newVol[newVol < limitSub + 1] = 0
-            newVol[newVol > limitHemi] = 0
-            nib.save(nib.Nifti1Image(newVol, affine), path_subj + 'parcellation/' +
-                     parcellation_name + '_leftHemisphere' + type + '.nii.gz')
-
-            # Right
-            newVol = vol.copy()
-            newVol[newVol < limitHemi + 1] = 0
-            nib.save(nib.Nifti1Image(newVol, affine), path_subj + 'parcellation/' +
-                     parcellation_name + '_rightHemisphere' + type + '.nii.gz')
-            # white matter
-            newVol = np.zeros(np.shape(vol))
-            newVol[vol == wmpar1] = wmpar1
-            newVol[vol == wmpar2] = wmpar2
-            nib.save(nib.Nifti1Image(newVol, affine), path_subj + 'parcellation/' +
-                     parcellation_name + '_whiteMatter' + type + '.nii.gz')
-
-            # masking subcortical
-            maskRegions = [1, 2, 3, 4, 5, 10, 11, 12, 15, 18, 19,
-                           20, 21, 22, 23, 24, 33, 34, 35, 36, 37, 38, 39, 40, 41]
-
-            volNew = volRenum.copy()
-            ind = 1
-
-            for Region in np.unique(volRenum)[1:]:
-                if Region in maskRegions:
-                    volNew[volNew == Region] = 0
-                else:
-                    volNew[volNew == Region] = ind
-                    ind += 1
-
-            nib.save(nib.Nifti1Image(volNew, affine), path_subj + 'parcellation/' +
-                     parcellation_name + '_renum_subMask' + type + '.nii.gz')
+        # The parcellations expanded by the additional radii get the same
+        # merges and renumbering as the main expansion
+        radii = self.inputs.radii if isdefined(self.inputs.radii) else []
+        for type in ['', '_expanded'] + ['_expanded_r%d' % radius for radius in radii]:
+            if type:
+                img, vol = load_image(path_subj + 'parcellation/' +
+                                      parcellation_name + type + '.nii.gz')
+            affine = img.affine
+
+            # Every volume below is a lookup table over the labels of the
+            # parcellation, indexed with the label of every voxel
+            labels, inverse = label_index(vol)
+            labels = replace_labels(labels, merged_labels)
+            save_image(labels[inverse], affine, path_subj +
+                       'parcellation/' + parcellation_name + type + '.nii.gz')
+
+            renum = renumber_labels(labels, parcels).astype(float)
+            save_image(renum[inverse], affine, path_subj +
+                       'parcellation/' + parcellation_name + '_renum' + type + '.nii.gz')
+
+            # Only the requested variants are derived from the renumbered
+            # parcellation, and not for the additional radii
+            if type not in ['', '_expanded']:
+                continue
+            for name in PARCELLATION_VARIANTS:
+                output = self._derived_output(name, type)
+                if output in self.inputs.derived_outputs:
+                    lookup = derived_labels(renum, name, limitSub, limitHemi, [wmpar1, wmpar2])
+                    save_image(lookup[inverse], affine, path_subj + 'parcellation/' +
+                               parcellation_name + '_' + output + '.nii.gz')
+
+        if not set(['aparc', 'aparc_subMask']) & set(self.inputs.derived_outputs):
+            return runtime
 
         # masking subcortical for DK atlas
-        maskRegions = np.hstack([range(1, 8), range(14, 16), range(
-            19, 25), 25, range(29, 47), range(55, 57), 59, range(61, 999)])
-
         cmd = 'mri_aparc2aseg --s ' + path_subj.split('/')[-2] + ' --o ' + path_subj + 'parcellation/' + \
             'aparc.a2009s.nii.gz  --annot  aparc.a2009s  --rip-unknown --hypo-as-wm'
 
         call(cmd, shell=True)
 
-        vol = nib.load(path_subj + 'parcellation/' +
-                       'aparc.a2009s.nii.gz').get_data()
-        affine = nib.load(path_subj + 'parcellation/' +
-                          'aparc.a2009s.nii.gz').affine
-
-        vol[vol == 72] = 31
-        vol[vol == 80] = 0
-        vol[vol == 29] = 0
-        nib.save(nib.Nifti1Image(vol, affine), path_subj +
-                 'parcellation/' + 'aparc.a2009s.nii.gz')
+        img, vol = load_image(path_subj + 'parcellation/' + 'aparc.a2009s.nii.gz')
+        labels, inverse = label_index(vol)
+        labels = replace_labels(labels, merged_labels)
+        save_image(labels[inverse], img.affine, path_subj + 'parcellation/' + 'aparc.a2009s.nii.gz')
 
         maskRegions = np.hstack([range(1, 9), range(14, 17), range(
             19, 26), 27, range(29, 48), range(55, 58), 59, range(61, 1000)])
 
-        volNew = vol.copy()
-        ind = 1
-
-        for Region in np.unique(vol)[1:]:
-            if Region in maskRegions:
-                volNew[volNew == Region] = 0
-            else:
-                volNew[volNew == Region] = ind
-                ind += 1
-
-        nib.save(nib.Nifti1Image(volNew, affine), path_subj +
-                 'parcellation/aparc.a2009s_subMask.nii.gz')
+        values, position = np.unique(labels, return_inverse=True)
+        volNew = consecutive_labels(values, maskRegions)[position][inverse]
+        save_image(volNew, img.affine, path_subj + 'parcellation/aparc.a2009s_subMask.nii.gz')
 
         return runtime
 
+    def _derived_output(self, name, type):
+        if name == 'cortical_consecutive':
+            return 'cortical' + type + '_consecutive'
+        return name + type
+
     def _list_outputs(self):
         from nipype.utils.filemanip import split_filename
         import os
@@ -1205,26 +1261,17 @@ class ReunumberParcels(BaseInterface):
         path_subj = self.inputs.subjects_dir + '/' + self.inputs.subject_id + '/'
         parcellation_name = self.inputs.parcellation_name
 
-        outputs["cortical"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_cortical.nii.gz')
-        outputs["cortical_consecutive"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_cortical_consecutive.nii.gz')
-        outputs["cortical_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_cortical_expanded.nii.gz')
-        outputs["cortical_expanded_consecutive"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name +  '_cortical_expanded_consecutive.nii.gz')
-        outputs["leftHemisphere"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_leftHemisphere.nii.gz')
-        outputs["leftHemisphere_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_leftHemisphere_expanded.nii.gz')
-        outputs["orig"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_orig.nii.gz')
-        outputs["renum"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_renum.nii.gz')
-        outputs["renum_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_renum_expanded.nii.gz')
-        outputs["renum_subMask"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_renum_subMask.nii.gz')
-        outputs["rightHemisphere"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_rightHemisphere.nii.gz')
-        outputs["rightHemisphere_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_rightHemisphere_expanded.nii.gz')
-        outputs["subcortical"] = os.path.abspath(path_subj + 'parcellation/' +parcellation_name +  '_subcortical.nii.gz')
-        outputs["subcortical_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name +  '_subcortical_expanded.nii.gz')
-        outputs["whiteMatter"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_whiteMatter.nii.gz')
-        outputs["whiteMatter_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_whiteMatter_expanded.nii.gz')
+        derived_outputs = [name for name in self.inputs.derived_outputs if not name.startswith('aparc')]
+        for name in ['orig', 'renum', 'renum_expanded'] + derived_outputs:
+            outputs[name] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_' + name + '.nii.gz')
+        if isdefined(self.inputs.radii):
+            outputs["renum_expanded_radii"] = [os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_renum_expanded_r%d.nii.gz' % radius)
+                                               for radius in self.inputs.radii]
         outputs["boundary_lh_rh"] = os.path.abspath(path_subj + 'parcellation/' + 'boundary_lh_rh.txt')
         outputs["boundary_sub_lh"] = os.path.abspath(path_subj + 'parcellation/' + 'boundary_sub_lh.txt')
-        outputs["aparc"] = os.path.abspath(path_subj + 'parcellation/' + 'aparc.a2009s.nii.gz')
-        outputs["aparc_subMask"] = os.path.abspath(path_subj + 'parcellation/' + 'aparc.a2009s_subMask.nii.gz')
+        if 'aparc' in self.inputs.derived_outputs or 'aparc_subMask' in self.inputs.derived_outputs:
+            outputs["aparc"] = os.path.abspath(path_subj + 'parcellation/' + 'aparc.a2009s.nii.gz')
+            outputs["aparc_subMask"] = os.path.abspath(path_subj + 'parcellation/' + 'aparc.a2009s_subMask.nii.gz')
         return outputs
 
 
@@ -0,0 +1,178 @@
+import io
+import os
+import struct
+import zlib
+
+import numpy as np
+
+
+# ==================================================================
+"""
+NIfTI input
+Each image is opened once and its header, affine and data come from the same
+nibabel image. The data is read through the array proxy instead of the
+deprecated get_data(): uncompressed images are memory mapped (copy on write,
+so in-place changes never reach the file) and compressed images are
+decompressed once. With lazy=True the array proxy itself is returned, which
+reads only the slices that are indexed. Reading a compressed image slice by
+slice decompresses it again from the start for every slice, so an image that
+is read out of core is first decompressed once to an uncompressed copy.
+"""
+
+
+def load_image(filename, lazy=False):
+    """nibabel image of `filename` and its data array (or array proxy if
+    `lazy`)."""
+    import nibabel as nib
+
+    img = nib.load(filename)
+    if lazy:
+        return img, img.dataobj
+    return img, np.asanyarray(img.dataobj)
+
+
+def decompress_image(filename, out_filename, block_size=1 << 24):
+    """Decompress a .nii.gz image to `out_filename` in one sequential pass."""
+    import gzip
+    import shutil
+
+    with gzip.open(filename, 'rb') as src, open(out_filename, 'wb') as dst:
+        shutil.copyfileobj(src, dst, block_size)
+    return out_filename
+
+
+# ==================================================================
+"""
+NIfTI output
+Images are written through save_image. Compressed (.nii.gz) images are
+streamed to a single-member gzip file whose blocks are deflated in a pool of
+threads, as pigz does; zlib releases the GIL, so compression scales with the
+number of threads. Each block but the last ends with a sync flush, so the
+blocks join into one deflate stream that any gzip reader can read.
+
+The compression level (0-9, 0 for stored blocks, e.g. for scratch
+intermediates) and the number of threads can be given per call, and
+default to the CONNECTOME_NIFTI_COMPRESSION and CONNECTOME_NIFTI_THREADS
+environment variables, so they reach the interfaces of every node and
+sub-workflow. Without them, the level is nibabel's default of 1 and one
+thread is used, as by the n_jobs inputs of the interfaces. If writing the
+image fails, the incomplete file is removed instead of being finished with a
+valid gzip trailer.
+"""
+
+COMPRESSION_VARIABLE = 'CONNECTOME_NIFTI_COMPRESSION'
+THREADS_VARIABLE = 'CONNECTOME_NIFTI_THREADS'
+
+
+def compression_settings(level=None, n_threads=None):
+    """Compression level and number of threads, from the arguments or the
+    environment."""
+    if level is None:
+        level = int(os.environ.get(COMPRESSION_VARIABLE, 1))
+    if n_threads is None:
+        n_threads = int(os.environ.get(THREADS_VARIABLE, 1))
+    return level, max(n_threads, 1)
+
+
+def _deflate_block(block, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipFile(io.RawIOBase):
+    """Write-only file object writing a gzip file with blocks compressed in
+    parallel threads. At most two blocks per thread are held in memory."""
+
+    def __init__(self, filename, level=1, n_threads=1, block_size=1 << 22):
+        from multiprocessing.pool import ThreadPool
+
+        super(ParallelGzipFile, self).__init__()
+        self.filename = filename
+        self.level = level
+        self.n_threads = n_threads
+        self.block_size = block_size
+        self._file = open(filename, 'wb')
+        self._pool = ThreadPool(n_threads)
+        self._pending = list()
+        self._buffer = bytearray()
+        self._crc = 0
+        self._size = 0
+
+        # No file name or modification time, unknown OS
+        extra_flags = {1: 4, 9: 2}.get(level, 0)
+        self._file.write(b'\x1f\x8b\x08\x00' + struct.pack('<I', 0) + struct.pack('<BB', extra_flags, 255))
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block, False)
+        return len(data)
+
+    def _submit(self, block, last):
+        self._pending.append(self._pool.apply_async(_deflate_block, (block, self.level, last)))
+        while len(self._pending) > 2 * self.n_threads or (self._pending and self._pending[0].ready()):
+            self._file.write(self._pending.pop(0).get())
+
+    def tell(self):
+        return self._size
+
+    def seek(self, offset, whence=0):
+        # Only the current position can be reached, nibabel then pads with zeros
+        if whence != 0 or offset != self._size:
+            raise OSError('cannot seek in a parallel gzip file')
+        return offset
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._submit(bytes(self._buffer), True)
+            for result in self._pending:
+                self._file.write(result.get())
+            self._file.write(struct.pack('<II', self._crc & 0xffffffff, self._size & 0xffffffff))
+        except BaseException:
+            self.abort()
+            raise
+        self._pool.terminate()
+        self._file.close()
+        super(ParallelGzipFile, self).close()
+
+    def abort(self):
+        """Close without writing the gzip trailer and remove the file."""
+        if self.closed:
+            return
+        try:
+            self._pool.terminate()
+            self._file.close()
+            os.remove(self.filename)
+        finally:
+            super(ParallelGzipFile, self).close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def save_image(data, affine, filename, header=None, level=None, n_threads=None):
+    """Save `data` as a NIfTI image, compressed with parallel threads if
+    `filename` ends with .gz."""
+    import nibabel as nib
+
+    img = nib.Nifti1Image(data, affine, header)
+    if not filename.endswith('.gz'):
+        nib.save(img, filename)
+        return
+
+    level, n_threads = compression_settings(level, n_threads)
+    with ParallelGzipFile(filename, level, n_threads) as fileobj:
+        img.to_file_map({'image': nib.FileHolder(filename, fileobj)})
@@ -0,0 +1,218 @@
+import numpy as np
+
+
+# ==================================================================
+"""
+Regional statistics
+Voxels are assigned to atlas regions once. Every image is then reduced per
+region with bincount (mean, standard deviation) and a single sort by
+(region, value) (median, percentiles), so the cost is a few linear passes per
+image regardless of the number of regions.
+"""
+
+
+def regional_statistics(atlas, images, names, percentiles=(5, 25, 75, 95)):
+    """Table with one row per atlas region (background excluded) and the
+    voxel count plus mean, std, median and percentiles of every image.
+    """
+    import pandas as pd
+
+    labels = np.asarray(atlas).astype(np.intp).ravel()
+    voxels = np.flatnonzero(labels > 0)
+    regions, region_index, counts = np.unique(labels[voxels], return_inverse=True, return_counts=True)
+    start = np.cumsum(counts) - counts
+
+    results = pd.DataFrame(index=pd.Index(regions, name='region'))
+    results['voxels'] = counts
+
+    for name, image in zip(names, images):
+        values = np.asarray(image, dtype=np.float64).ravel()[voxels]
+
+        mean = np.bincount(region_index, weights=values, minlength=len(regions)) / counts
+        deviation = values - mean[region_index]
+        std = np.sqrt(np.bincount(region_index, weights=deviation ** 2, minlength=len(regions)) / counts)
+
+        ordered = values[np.lexsort((values, region_index))]
+
+        results[name + '_mean'] = mean
+        results[name + '_std'] = std
+        results[name + '_median'] = _group_percentile(ordered, start, counts, 50)
+        for q in percentiles:
+            results[name + '_p' + ('%g' % q)] = _group_percentile(ordered, start, counts, q)
+
+    return results
+
+
+def _group_percentile(ordered, start, counts, q):
+    """Percentile of each group of sorted values, interpolated as in np.percentile."""
+    position = (counts - 1) * (q / 100.)
+    lower = np.floor(position).astype(np.intp)
+    upper = np.ceil(position).astype(np.intp)
+    fraction = position - lower
+    return ordered[start + lower] + fraction * (ordered[start + upper] - ordered[start + lower])
+
+
+# ==================================================================
+"""
+Parcel expansion
+Cortical parcels (labels above 1000) are expanded into the white matter
+(labels 2 and 41). Every white matter voxel takes one of the cortical labels
+found in the cube of `radius` voxels around it, as in the original
+voxel-by-voxel implementation: the label whose centroid has the smallest
+squared offset on any axis from the first voxel coordinate. Neighbours at
+index 0 are skipped. The cube is scanned one offset at a time for all white
+matter voxels together, keeping the best label so far, and the centroids of
+all parcels are computed in one pass.
+Offsets are scanned in shells of increasing radius, so the best labels after
+the shell of radius r are the expansion for radius r. Several radii are
+therefore expanded in a single pass, each larger radius continuing from the
+assignments of the smaller one.
+"""
+
+
+def parcel_centroids(volume, labels):
+    """Centroid (in voxel coordinates) of each label in `labels`."""
+    volume = np.asarray(volume)
+    position = np.searchsorted(labels, volume.ravel())
+    position = np.minimum(position, len(labels) - 1)
+    voxels = np.flatnonzero(labels[position] == volume.ravel())
+    counts = np.bincount(position[voxels], minlength=len(labels)).astype(float)
+
+    coordinates = np.unravel_index(voxels, volume.shape)
+    return np.column_stack([np.bincount(position[voxels], weights=axis, minlength=len(labels)) / counts
+                            for axis in coordinates])
+
+
+def expand_parcels_radii(volume, radii, white_matter_labels=(2, 41), min_label=1000):
+    """Yield (radius, expanded volume) for each of `radii` in increasing
+    order, from one incremental pass over the neighbourhood offsets."""
+    volume = np.asarray(volume)
+    radii = sorted(set(radii))
+
+    parcels = np.unique(volume)
+    parcels = parcels[parcels > min_label]
+    if not len(parcels):
+        for radius in radii:
+            yield radius, volume.copy()
+        return
+    centroids = parcel_centroids(volume, parcels)
+
+    white_matter = np.array(np.nonzero(np.isin(volume, white_matter_labels)))
+    best_score = np.full(white_matter.shape[1], np.inf)
+    best_parcel = np.full(white_matter.shape[1], -1, dtype=np.intp)
+    shape = np.asarray(volume.shape)[:, np.newaxis]
+
+    offsets = np.arange(-max(radii[-1], 0), max(radii[-1], 0) + 1)
+    offsets = np.array(np.meshgrid(offsets, offsets, offsets, indexing='ij')).reshape(3, -1).T
+    shells = np.max(np.abs(offsets), axis=1)
+
+    # The centre of the cube is the white matter voxel itself
+    scanned = 0
+    for radius in radii:
+        for offset in offsets[(shells > scanned) & (shells <= radius)]:
+            neighbours = white_matter + offset[:, np.newaxis]
+            valid = np.all((neighbours > 0) & (neighbours < shape), axis=0)
+            labels = np.zeros(white_matter.shape[1], dtype=volume.dtype)
+            labels[valid] = volume[tuple(neighbours[:, valid])]
+
+            voxels = np.flatnonzero(labels > min_label)
+            parcel = np.searchsorted(parcels, labels[voxels])
+            score = np.min((centroids[parcel] - white_matter[0, voxels, np.newaxis]) ** 2, axis=1)
+
+            # Ties go to the lowest label
+            better = (score < best_score[voxels]) | ((score == best_score[voxels]) & (parcel < best_parcel[voxels]))
+            best_score[voxels[better]] = score[better]
+            best_parcel[voxels[better]] = parcel[better]
+        scanned = max(scanned, radius)
+
+        expanded = volume.copy()
+        assigned = best_parcel >= 0
+        expanded[tuple(white_matter[:, assigned])] = parcels[best_parcel[assigned]]
+        yield radius, expanded
+
+
+def expand_parcels(volume, radius, white_matter_labels=(2, 41), min_label=1000):
+    """Copy of `volume` with the white matter labelled by nearby parcels."""
+    for _, expanded in expand_parcels_radii(volume, [radius], white_matter_labels, min_label):
+        return expanded
+
+
+# ==================================================================
+"""
+Label lookup tables
+The labels of a parcellation are found once with np.unique, which also gives
+the position of every voxel's label among them. Relabelling, renumbering and
+masking are then computed on the few unique labels as lookup tables, and a
+relabelled volume is a single indexing of its lookup table with the label
+positions, instead of one pass over the volume per label.
+The renumbered labelling and the boundaries between subcortical, left and
+right hemisphere parcels are all that is needed to derive the other variants
+of a parcellation, so these can be derived on demand.
+"""
+
+PARCELLATION_VARIANTS = ('subcortical', 'cortical', 'cortical_consecutive', 'leftHemisphere',
+                         'rightHemisphere', 'whiteMatter', 'renum_subMask')
+
+# Renumbered subcortical regions masked out of renum_subMask
+SUBCORTICAL_MASK = (1, 2, 3, 4, 5, 10, 11, 12, 15, 18, 19,
+                    20, 21, 22, 23, 24, 33, 34, 35, 36, 37, 38, 39, 40, 41)
+
+
+def label_index(volume):
+    """Sorted unique labels of `volume` and the position of every voxel's
+    label among them, with the shape of the volume."""
+    volume = np.asarray(volume)
+    labels, inverse = np.unique(volume, return_inverse=True)
+    return labels, inverse.reshape(volume.shape)
+
+
+def replace_labels(labels, replacements):
+    """Copy of `labels` with the labels in the `replacements` dict replaced."""
+    replaced = labels.copy()
+    for label, new_label in replacements.items():
+        replaced[labels == label] = new_label
+    return replaced
+
+
+def renumber_labels(labels, parcels):
+    """Position of each of `labels` in the sorted `parcels`; the first parcel
+    and labels that are not parcels are numbered 0."""
+    position = np.minimum(np.searchsorted(parcels, labels), len(parcels) - 1)
+    return np.where(parcels[position] == labels, position, 0)
+
+
+def consecutive_labels(labels, masked):
+    """Lookup table over the sorted unique `labels` that sets the `masked`
+    labels to 0 and numbers the others 1, 2, ... in order. The first
+    (background) label is kept."""
+    kept = ~np.isin(labels, masked)
+    kept[0] = False
+    numbered = np.where(kept, np.cumsum(kept), 0).astype(labels.dtype)
+    numbered[0] = labels[0]
+    return numbered
+
+
+def derived_labels(renum, name, limit_sub, limit_hemi, white_matter=(1, 20), masked=SUBCORTICAL_MASK):
+    """One of the `PARCELLATION_VARIANTS` of the renumbered labels `renum`
+    (a renumbered volume or a lookup table over the labels of one), which
+    number subcortical parcels up to `limit_sub` and left hemisphere parcels
+    up to `limit_hemi`."""
+    renum = np.asarray(renum)
+    if name == 'renum_subMask':
+        values, position = np.unique(renum, return_inverse=True)
+        return consecutive_labels(values, masked)[position].reshape(renum.shape)
+
+    white_matter = np.isin(renum, white_matter)
+    if name == 'subcortical':
+        return np.where((renum <= limit_sub) & ~white_matter, renum, 0)
+    if name == 'cortical':
+        return np.where((renum > limit_sub) & ~white_matter, renum, 0)
+    if name == 'cortical_consecutive':
+        return np.where((renum > limit_sub) & ~white_matter, renum - limit_sub, 0)
+    if name == 'leftHemisphere':
+        return np.where((renum > limit_sub) & (renum <= limit_hemi), renum, 0)
+    if name == 'rightHemisphere':
+        return np.where(renum > limit_hemi, renum, 0)
+    if name == 'whiteMatter':
+        return np.where(white_matter, renum, 0)
+    raise ValueError('unknown parcellation variant ' + name)
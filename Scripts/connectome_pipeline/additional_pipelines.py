@@ -1,9 +1,12 @@
 from nipype.interfaces.base import BaseInterface
 from nipype.interfaces.base import BaseInterfaceInputSpec
 from nipype.interfaces.base import File
+from nipype.interfaces.base import isdefined
 from nipype.interfaces.base import traits
 from nipype.interfaces.base import TraitedSpec
 
+from additional_interfaces import DERIVED_OUTPUT
+
 # ======================================================================
 # DWI preprocessing
 
@@ -16,6 +19,8 @@ class DWIPreprocInputSpec(BaseInterfaceInputSpec):
     subject_id = traits.String(desc='subject ID', mandatory=True)
     out_directory = File(
         desc='directory where to dwi should be directed', mandatory=True)
+    n_jobs = traits.Int(1, usedefault=True, desc='number of processes used for denoising')
+    out_of_core = traits.Bool(False, usedefault=True, desc='denoise one volume at a time from disk to bound memory, the denoised DWI is then float32')
 
 class DWIPreprocOutputSpec(TraitedSpec):
     AD = File(exist=True, desc='axial diffusivity image')
@@ -64,6 +69,8 @@ class DWIPreproc(BaseInterface):
         # Denoising
         dwi_denoise = pe.Node(interface=DipyDenoise(), name='dwi_denoise')
         dwi_denoise.inputs.in_file = self.inputs.dwi
+        dwi_denoise.inputs.n_jobs = self.inputs.n_jobs
+        dwi_denoise.inputs.out_of_core = self.inputs.out_of_core
 
         # Fitting the diffusion tensor model
         dtifit = pe.Node(interface=fsl.DTIFit(), name='dtifit')
@@ -166,6 +173,10 @@ class SubjectSpaceParcellationInputSpec(BaseInterfaceInputSpec):
     out_directory = File(
         exist=True, desc='directory where FreeSurfer output should be directed')
     wm = File(exit=True, desc='segmented white matter image')
+    dilatationVoxel = traits.Int(2, usedefault=True, desc='number of voxels to dilate the cortical parcellation by')
+    expansion_radii = traits.List(traits.Int, desc='additional dilatation radii for sensitivity analyses')
+    derived_outputs = traits.List(DERIVED_OUTPUT, [], usedefault=True,
+                                  desc='derived parcellations to write (see ReunumberParcels)')
 
 class SubjectSpaceParcellationOutputSpec(TraitedSpec):
     subject_id = traits.String(desc='subject ID')
@@ -181,7 +192,9 @@ class SubjectSpaceParcellationOutputSpec(TraitedSpec):
     orig = File(exists=True, desc="original parcellation image")
     renum = File(exists=True, desc="renumbered parcellation")
     renum_expanded = File(exists=True, desc="renumbered parcellation expanded into WM")
+    renum_expanded_radii = traits.List(File(exists=True), desc="renumbered parcellations expanded into WM by each of the expansion radii")
     renum_subMask = File(exists=True, desc="renumbered parcellation with subcortical regions masked out")
+    renum_subMask_expanded = File(exists=True, desc="renumbered parcellation expanded into WM with subcortical regions masked out")
     rightHemisphere = File(exists=True, desc="parcellation of the right hemisphere")
     rightHemisphere_expanded = File(exists=True, desc="parcellation of the right hemisphere expanded into WM")
     subcortical = File(exists=True, desc="parcellation of subcortical regions")
@@ -190,6 +203,7 @@ class SubjectSpaceParcellationOutputSpec(TraitedSpec):
     whiteMatter_expanded = File(exists=True, desc="white matter partial image after expansion of cortical parcellation into WM")
     boundary_lh_rh = File(exists=True, desc="boundary label between hemisphere")
     boundary_sub_lh = File(exists=True, desc="oundary label between cortical and subcortical")
+    expanded_radii = traits.List(File(exists=True), desc="parcellations expanded into WM by each of the expansion radii")
 
 class SubjectSpaceParcellation(BaseInterface):
     input_spec = SubjectSpaceParcellationInputSpec
@@ -239,11 +253,16 @@ class SubjectSpaceParcellation(BaseInterface):
         expand.inputs.white_matter_image = wm
         expand.inputs.subjects_dir = subjects_dir
         expand.inputs.parcellation_name = source_annot_file
-        expand.inputs.dilatationVoxel = 2
+        expand.inputs.dilatationVoxel = self.inputs.dilatationVoxel
+        if isdefined(self.inputs.expansion_radii):
+            expand.inputs.radii = self.inputs.expansion_radii
 
         renum = pe.Node(interface=ReunumberParcels(), name='renum')
         renum.inputs.subjects_dir = subjects_dir
         renum.inputs.parcellation_name = source_annot_file
+        renum.inputs.derived_outputs = self.inputs.derived_outputs
+        if isdefined(self.inputs.expansion_radii):
+            renum.inputs.radii = self.inputs.expansion_radii
 
         # Connecting the pipeline
         subject_parcellation = pe.Workflow(name='subject_parcellation')
@@ -273,26 +292,18 @@ class SubjectSpaceParcellation(BaseInterface):
         parcellation_name = self.inputs.source_annot_file
 
         outputs["aparc"] = self.inputs.source_annot_file
-        outputs["cortical"] = os.path.abspath(path_subj + '/parcellation/' + parcellation_name + '_cortical.nii.gz')
-        outputs["cortical_consecutive"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_cortical_consecutive.nii.gz')
-        outputs["cortical_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_cortical_expanded.nii.gz')
-        outputs["cortical_expanded_consecutive"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name +  '_cortical_expanded_consecutive.nii.gz')
-        outputs["leftHemisphere"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_leftHemisphere.nii.gz')
-        outputs["leftHemisphere_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_leftHemisphere_expanded.nii.gz')
-        outputs["orig"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_orig.nii.gz')
-        outputs["renum"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_renum.nii.gz')
-        outputs["renum_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_renum_expanded.nii.gz')
-        outputs["renum_subMask"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_renum_subMask.nii.gz')
-        outputs["rightHemisphere"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_rightHemisphere.nii.gz')
-        outputs["rightHemisphere_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_rightHemisphere_expanded.nii.gz')
-        outputs["subcortical"] = os.path.abspath(path_subj + 'parcellation/' +parcellation_name +  '_subcortical.nii.gz')
-        outputs["subcortical_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name +  '_subcortical_expanded.nii.gz')
+        derived_outputs = [name for name in self.inputs.derived_outputs if not name.startswith('aparc')]
+        for name in ['orig', 'renum', 'renum_expanded'] + derived_outputs:
+            outputs[name] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_' + name + '.nii.gz')
         outputs["subject_id"] = self.inputs.subject_id
         outputs["subjects_dir"] = self.inputs.subjects_dir
-        outputs["whiteMatter"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_whiteMatter.nii.gz')
-        outputs["whiteMatter_expanded"] = os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_whiteMatter_expanded.nii.gz')
         outputs["boundary_lh_rh"] = os.path.abspath(path_subj + 'parcellation/' + 'boundary_lh_rh.txt')
         outputs["boundary_sub_lh"] = os.path.abspath(path_subj + 'parcellation/' + 'boundary_sub_lh.txt')
+        if isdefined(self.inputs.expansion_radii):
+            outputs["expanded_radii"] = [os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_expanded_r%d.nii.gz' % radius)
+                                         for radius in self.inputs.expansion_radii]
+            outputs["renum_expanded_radii"] = [os.path.abspath(path_subj + 'parcellation/' + parcellation_name + '_renum_expanded_r%d.nii.gz' % radius)
+                                               for radius in self.inputs.expansion_radii]
         return outputs
 
 
@@ -308,6 +319,7 @@ class T1PreprocInputSpec(BaseInterfaceInputSpec):
     out_directory = File(
         exist=True, desc='directory where FreeSurfer output should be directed')
     parcellation_directory = File(exist=True, desc='directory containing the parcellation file')
+    n_jobs = traits.Int(1, usedefault=True, desc='number of processes used for denoising')
 
 class T1PreprocOutputSpec(TraitedSpec):
     brainmask = File(exist=True, desc='brain mask generated by FreeSurfer')
@@ -349,6 +361,7 @@ class T1Preproc(BaseInterface):
 
         # Denoising
         T1_denoise = pe.Node(interface=DipyDenoiseT1(), name='T1_denoise')
+        T1_denoise.inputs.n_jobs = self.inputs.n_jobs
 
         # Brain extraction
         brainextraction = pe.Node(interface=fsl.BET(), name='brainextraction')
@@ -0,0 +1,479 @@
+import numpy as np
+
+
+# ==================================================================
+"""
+Parallel chunked tracking
+Seeds are split into fixed-size chunks that are tracked by a pool of forked
+processes. The direction getter and stopping criterion are inherited by the
+workers through fork instead of being pickled. Each chunk is tracked with
+random_seed + chunk number, so probabilistic tracking is reproducible for a
+given chunk size independently of the number of processes, and chunks are
+returned in seed order. Reseeding every chunk also keeps the workers from
+drawing the random state they all inherit from the parent.
+"""
+
+_tracking_state = dict()
+
+
+def _track_chunk(job):
+    from dipy.tracking.local_tracking import LocalTracking
+    from dipy.tracking.streamline import Streamlines
+
+    chunk, seeds = job
+    state = _tracking_state
+    streamlines = Streamlines(LocalTracking(state['direction_getter'], state['stopping_criterion'],
+                                            seeds, state['affine'], random_seed=state['random_seed'] + chunk,
+                                            **state['kwargs']))
+    return streamlines.get_data(), np.asarray(streamlines._lengths)
+
+
+def track_in_chunks(direction_getter, stopping_criterion, seeds, affine, n_jobs=1,
+                    chunk_size=5000, random_seed=0, **kwargs):
+    """Generator of Streamlines, one per chunk of seeds, in seed order.
+
+    `seeds` is an array of seed points, or an iterable of seed arrays that
+    are used as chunks as they are (e.g. random_seed_chunks). Keyword
+    arguments are passed on to LocalTracking. Tracking runs serially when
+    n_jobs is 1 or when called from a daemonic process, which cannot start a
+    pool of its own. At most 2 * n_jobs chunks are in flight, so seed chunks
+    are drawn lazily and closing the generator stops tracking.
+    """
+    import multiprocessing
+    from dipy.tracking.streamline import Streamlines
+
+    _tracking_state.update(direction_getter=direction_getter, stopping_criterion=stopping_criterion,
+                           affine=affine, random_seed=random_seed, kwargs=kwargs)
+    if isinstance(seeds, np.ndarray):
+        jobs = enumerate(seeds[start:start + chunk_size] for start in range(0, len(seeds), chunk_size))
+    else:
+        jobs = enumerate(seeds)
+
+    if n_jobs == 1 or multiprocessing.current_process().daemon:
+        results = (_track_chunk(job) for job in jobs)
+        pool = None
+    else:
+        pool = multiprocessing.get_context('fork').Pool(n_jobs)
+        results = _bounded_imap(pool, _track_chunk, jobs, 2 * n_jobs)
+
+    try:
+        for points, lengths in results:
+            streamlines = Streamlines()
+            streamlines._data = points
+            streamlines._lengths = lengths
+            streamlines._offsets = np.cumsum(lengths) - lengths
+            yield streamlines
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _tracking_state.clear()
+
+
+def _bounded_imap(pool, function, jobs, n_pending):
+    """pool.imap that only draws new jobs as results are consumed."""
+    import collections
+    import itertools
+
+    pending = collections.deque(pool.apply_async(function, (job,))
+                                for job in itertools.islice(jobs, n_pending))
+    while pending:
+        result = pending.popleft().get()
+        for job in itertools.islice(jobs, 1):
+            pending.append(pool.apply_async(function, (job,)))
+        yield result
+
+
+# ==================================================================
+"""
+Seeding budgets
+Instead of seeding every white matter voxel, seeds can be drawn uniformly at
+random inside the mask until a target number of streamlines is reached or a
+wall-clock budget is spent. Seed chunks are drawn in the parent process from
+one random stream, so the seeds only depend on random_seed and the chunk
+size, not on the number of processes.
+"""
+
+
+def random_seed_chunks(mask, affine, chunk_size=5000, random_seed=0):
+    """Endless generator of arrays of random seed points inside `mask`."""
+    from nibabel.affines import apply_affine
+
+    voxels = np.argwhere(np.asarray(mask) > 0)
+    if not len(voxels):
+        return
+    # Seeded apart from the tracking chunks, which use random_seed + chunk number
+    rng = np.random.RandomState([random_seed, 1])
+    while True:
+        points = voxels[rng.randint(len(voxels), size=chunk_size)] + rng.uniform(-.5, .5, (chunk_size, 3))
+        yield apply_affine(affine, points)
+
+
+def limit_streamlines(chunks, n_streamlines=None, time_budget=None):
+    """Pass on streamline chunks until `n_streamlines` streamlines have been
+    produced (the last chunk is cut to size) or `time_budget` seconds have
+    passed. The budget is checked after every chunk, then `chunks` is closed.
+    """
+    import time
+
+    start = time.time()
+    count = 0
+    try:
+        for chunk in chunks:
+            if n_streamlines is not None:
+                chunk = chunk[:n_streamlines - count]
+            count += len(chunk)
+            yield chunk
+            if n_streamlines is not None and count >= n_streamlines:
+                break
+            if time_budget is not None and time.time() - start >= time_budget:
+                break
+    finally:
+        chunks.close()
+
+
+# ==================================================================
+"""
+Streaming tractogram writer
+Streamlines arrive in chunks in voxel space and are written to a TrackVis
+file, and optionally a tractogram container, as they are produced. The
+density map (number of streamlines per voxel) is accumulated from the same
+chunks at full resolution before they are compressed. Only one chunk is held
+in memory at a time. TrackVis headers have no field for the compression
+tolerance, so it is written to a JSON sidecar next to the .trk file (the
+container records it in its attributes), from which the connectome knows to
+subdivide the compressed streamlines.
+"""
+
+
+def trk_attributes_file(filename):
+    return filename + '.json'
+
+
+def trk_attributes(filename):
+    """Attributes written with a .trk file by StreamingTractogramWriter, empty
+    if there are none."""
+    import json
+    import os
+
+    if not os.path.exists(trk_attributes_file(filename)):
+        return dict()
+    with open(trk_attributes_file(filename)) as f:
+        return json.load(f)
+
+
+def compress_chunk(chunk, affine, tol_error, max_segment_length=10.):
+    """Voxel-space streamlines with nearly collinear points removed, so that
+    no removed point is more than `tol_error` mm from the compressed
+    streamline and no segment is longer than `max_segment_length` mm.
+
+    Both tolerances are converted to voxel units with the largest scaling
+    of the affine, so the bounds hold for anisotropic voxels too.
+    """
+    from dipy.tracking.streamline import Streamlines
+    from dipy.tracking.streamlinespeed import compress_streamlines
+
+    scale = np.linalg.norm(np.asarray(affine, dtype=float)[:3, :3], 2)
+    return Streamlines(compress_streamlines(list(chunk), tol_error=tol_error / scale,
+                                            max_segment_length=max_segment_length / scale))
+
+
+class StreamingTractogramWriter(object):
+
+    def __init__(self, reference_img, tol_error=None, max_segment_length=10., container=None):
+        self.reference_img = reference_img
+        self.shape = reference_img.shape[:3]
+        self.density = np.zeros(int(np.prod(self.shape)), dtype=np.int64)
+        self.n_streamlines = 0
+        self.tol_error = tol_error
+        self.max_segment_length = max_segment_length
+        self.container = container
+
+    def _update_density(self, chunk):
+        from additional_connectome import point_index
+        from additional_connectome import streamline_arrays
+        from additional_connectome import voxel_coordinates
+
+        points, offsets, lengths = streamline_arrays(chunk)
+        rows, index = point_index(offsets, lengths)
+        ijk = voxel_coordinates(points[index], np.eye(4))
+        inside = np.all((ijk >= 0) & (ijk < np.asarray(self.shape)), axis=1)
+        voxels = np.ravel_multi_index(tuple(ijk[inside].T), self.shape)
+
+        # Every streamline counts once per voxel
+        n_voxels = len(self.density)
+        visits = np.unique(rows[inside].astype(np.int64) * n_voxels + voxels)
+        self.density += np.bincount(visits % n_voxels, minlength=n_voxels)
+
+    def process(self, chunks):
+        """Update the density map from each chunk, then compress it and
+        append it to the container if these are used, and pass it on.
+        """
+        for chunk_number, chunk in enumerate(chunks):
+            self._update_density(chunk)
+            self.n_streamlines += len(chunk)
+            if self.tol_error is not None:
+                chunk = compress_chunk(chunk, self.reference_img.affine, self.tol_error, self.max_segment_length)
+            if self.container is not None:
+                # The seed chunk identifies the random seed of every streamline
+                self.container.append(chunk, seed_chunk=np.full(len(chunk), chunk_number, dtype=np.int32))
+            yield chunk
+
+    def _rasmm_streamlines(self, chunks):
+        from nibabel.affines import apply_affine
+        from additional_connectome import streamline_arrays
+
+        affine = self.reference_img.affine
+        for chunk in self.process(chunks):
+            points, offsets, lengths = streamline_arrays(chunk)
+            points = apply_affine(affine, points)
+            for offset, length in zip(offsets, lengths):
+                yield points[offset:offset + length]
+
+    def write_trk(self, chunks, filename):
+        """Write voxel-space streamline chunks to a .trk file."""
+        import nibabel as nib
+        from nibabel.streamlines import TrkFile
+        from dipy.io.utils import create_tractogram_header
+        from dipy.io.utils import get_reference_info
+
+        header = create_tractogram_header(TrkFile, *get_reference_info(self.reference_img))
+        tractogram = nib.streamlines.LazyTractogram(lambda: self._rasmm_streamlines(chunks),
+                                                    affine_to_rasmm=np.eye(4))
+        TrkFile(tractogram, header=header).save(filename)
+
+        # A sidecar left by an earlier run must not describe this file
+        import json
+        import os
+        if self.tol_error is None:
+            if os.path.exists(trk_attributes_file(filename)):
+                os.remove(trk_attributes_file(filename))
+            return
+        with open(trk_attributes_file(filename), 'w') as f:
+            json.dump(dict(tol_error=self.tol_error, max_segment_length=self.max_segment_length), f)
+
+    def density_map(self):
+        return self.density.reshape(self.shape)
+
+
+# ==================================================================
+"""
+Reconstruction model cache
+Fitted model products (CSA peaks and GFA, CSD SH coefficients and response)
+are stored as .npz files keyed by a digest of the input files and the fit
+parameters. Input files are identified by their path, size and modification
+time, so a cache hit reads none of them; hashing their contents (e.g. for
+files that are copied between runs) is optional. Later tracking runs on the same data, e.g. CSD after CSA or a
+rerun with different tracking parameters, load them instead of refitting.
+A lock per entry lets concurrent runs wait for a fit in progress instead of
+repeating it.
+"""
+
+
+class ReconstructionCache(object):
+
+    def __init__(self, directory):
+        import os
+        self.directory = os.path.abspath(directory)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    @staticmethod
+    def digest(filenames, contents=False, base='', block_size=2 ** 20):
+        """SHA-1 digest of the path, size and modification time of the input
+        files, or of their contents if `contents`, extending the digest `base`
+        of other inputs if given."""
+        import hashlib
+        import os
+        sha = hashlib.sha1(base.encode())
+        for filename in filenames:
+            if not contents:
+                stat = os.stat(filename)
+                sha.update(repr((os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)).encode())
+                continue
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(block_size), b''):
+                    sha.update(block)
+        return sha.hexdigest()
+
+    def get(self, name, data_digest, fit, **parameters):
+        """Arrays returned by fit(), loaded from the cache if available."""
+        import fcntl
+        import hashlib
+        import os
+
+        key = hashlib.sha1((data_digest + name + repr(sorted(parameters.items()))).encode()).hexdigest()
+        filename = os.path.join(self.directory, name + '_' + key + '.npz')
+
+        with open(filename + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(filename):
+                    with np.load(filename) as cached:
+                        return dict(cached)
+
+                arrays = fit()
+                with open(filename + '.tmp', 'wb') as f:
+                    np.savez(f, **arrays)
+                os.rename(filename + '.tmp', filename)
+                return arrays
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def cached_fit(cache, data_digest, name, fit, **parameters):
+    """cache.get(...) or fit() when no cache is used."""
+    if cache is None:
+        return fit()
+    return cache.get(name, data_digest, fit, **parameters)
+
+
+def peaks_to_arrays(peaks):
+    arrays = dict()
+    for attribute in ['peak_dirs', 'peak_values', 'peak_indices', 'gfa', 'qa', 'shm_coeff', 'B']:
+        if getattr(peaks, attribute, None) is not None:
+            arrays[attribute] = getattr(peaks, attribute)
+    return arrays
+
+
+def peaks_from_arrays(arrays, sphere):
+    """PeaksAndMetrics that can be used as a direction getter for tracking."""
+    from dipy.direction.peaks import PeaksAndMetrics
+
+    peaks = PeaksAndMetrics()
+    peaks.sphere = sphere
+    for attribute, value in arrays.items():
+        setattr(peaks, attribute, value)
+    return peaks
+
+
+# ==================================================================
+"""
+Parallel blockwise model fitting
+The volume is split into slabs along the first axis that are fitted by a
+pool of forked processes. The input data is shared with the workers through
+fork, and the workers write their results in place into output arrays in
+shared memory, so neither input nor output blocks are pickled. The first
+slab is fitted in the parent to find the shape of every output.
+"""
+
+_fitting_state = dict()
+
+
+def _fit_block(start):
+    state = _fitting_state
+    stop = start + state['block_size']
+    result = state['fit'](state['data'][start:stop], state['mask'][start:stop])
+    for name, output in state['outputs'].items():
+        output[start:stop] = result[name]
+
+
+def _shared_array(shape, dtype):
+    import multiprocessing
+    dtype = np.dtype(dtype)
+    buffer = multiprocessing.RawArray('b', max(int(np.prod(shape)) * dtype.itemsize, 1))
+    return np.frombuffer(buffer, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+
+def fit_in_blocks(fit, data, mask, n_jobs=1, block_size=4):
+    """Apply fit(data_block, mask_block) -> dict of arrays to slabs of the
+    volume and assemble the results.
+
+    Arrays whose leading dimensions match the slab are assembled into
+    volumes; any other array (e.g. a basis matrix) is taken from the first
+    slab.
+    """
+    import multiprocessing
+
+    mask = np.asarray(mask, dtype=bool)
+    first = fit(data[:block_size], mask[:block_size])
+
+    outputs = dict()
+    results = dict()
+    for name, value in first.items():
+        value = np.asarray(value)
+        if value.shape[:3] == mask[:block_size].shape:
+            outputs[name] = _shared_array(mask.shape + value.shape[3:], value.dtype)
+            outputs[name][:block_size] = value
+        else:
+            results[name] = value
+
+    _fitting_state.update(fit=fit, data=data, mask=mask, outputs=outputs, block_size=block_size)
+    starts = list(range(block_size, mask.shape[0], block_size))
+    try:
+        if n_jobs == 1 or multiprocessing.current_process().daemon:
+            for start in starts:
+                _fit_block(start)
+        else:
+            pool = multiprocessing.get_context('fork').Pool(n_jobs)
+            try:
+                pool.map(_fit_block, starts)
+            finally:
+                pool.terminate()
+    finally:
+        _fitting_state.clear()
+
+    results.update(outputs)
+    return results
+
+
+def csa_peaks_in_blocks(model, data, sphere, mask, n_jobs=1, block_size=4, **kwargs):
+    """peaks_from_model fitted in parallel slabs, returned as arrays.
+
+    peaks_from_model normalises QA by the largest peak of the volume it is
+    given, so QA is rescaled from the per-slab to the whole-volume maximum.
+    """
+    from dipy.direction import peaks_from_model
+
+    def fit(data_block, mask_block):
+        arrays = peaks_to_arrays(peaks_from_model(model, data_block, sphere, mask=mask_block, **kwargs))
+        arrays['qa'] = arrays['qa'] * max(arrays['peak_values'][..., 0].max(), 0)
+        return arrays
+
+    arrays = fit_in_blocks(fit, data, mask, n_jobs, block_size)
+    global_max = arrays['peak_values'][..., 0].max()
+    if global_max > 0:
+        arrays['qa'] = arrays['qa'] / global_max
+    return arrays
+
+
+def csd_shm_in_blocks(model, data, mask, n_jobs=1, block_size=4):
+    """SH coefficients of a CSD model fitted in parallel slabs."""
+
+    def fit(data_block, mask_block):
+        return dict(shm_coeff=model.fit(data_block, mask=mask_block).shm_coeff)
+
+    return fit_in_blocks(fit, data, mask, n_jobs, block_size)['shm_coeff']
+
+
+# ==================================================================
+"""
+Response functions
+Single-fibre response functions for CSD, estimated once per subject and
+stored as a one-line text file (eigenvalues and S0). A group-average
+response, the mean of the subject eigenvalues and S0, can be used instead
+of the subject responses so that CSD fits are consistent across a cohort.
+"""
+
+
+def estimate_response(gtab, data, roi_radius=10, fa_thr=.7):
+    from dipy.reconst.csdeconv import auto_response
+
+    response, ratio = auto_response(gtab, data, roi_radius=roi_radius, fa_thr=fa_thr)
+    return dict(response_evals=np.asarray(response[0]), response_S0=np.asarray(response[1]),
+                ratio=np.asarray(ratio))
+
+
+def save_response(filename, evals, S0):
+    np.savetxt(filename, np.append(evals, S0)[np.newaxis], header='eval1 eval2 eval3 S0')
+
+
+def load_response(filename):
+    """Response as (eigenvalues, S0), as returned by auto_response."""
+    values = np.loadtxt(filename)
+    return values[:3], float(values[3])
+
+
+def average_response(filenames):
+    """Group-average response of the given response files."""
+    values = np.mean([np.append(*load_response(filename)) for filename in filenames], axis=0)
+    return values[:3], float(values[3])
@@ -19,6 +19,14 @@ def main():
     p.add_option('--parcellation_directory', '-p')
     p.add_option('--acquisition_parameters', '-a')
     p.add_option('--index_file', '-i')
+    p.add_option('--cohort_store', '-c')
+    p.add_option('--n_jobs', '-n', type='int', default=1)
+    p.add_option('--fused', '-f', action='store_true', default=False,
+                 help='build the connectome while tracking, without saving the tractogram')
+    p.add_option('--group_response', '-g', action='store_true', default=False,
+                 help='use the average CSD response function of all subjects')
+    p.add_option('--compression_level', '-z', type='int',
+                 help='gzip level of the NIfTI outputs, 0 for uncompressed scratch runs')
     sys.path.append(os.path.realpath(__file__))
 
     options, arguments = p.parse_args()
@@ -31,6 +39,10 @@ def main():
     parcellation_directory = options.parcellation_directory
     acquisition_parameters = options.acquisition_parameters
     index_file = options.index_file
+    cohort_store = options.cohort_store
+    n_jobs = options.n_jobs
+    fused = options.fused
+    group_response = options.group_response
     subjects_dir = out_directory + '/connectome/FreeSurfer/'
 
     if not os.path.isdir(out_directory + '/connectome/'):
@@ -39,6 +51,12 @@ def main():
 
     os.environ['SUBJECTS_DIR'] = subjects_dir
 
+    # NIfTI outputs are compressed with n_jobs threads
+    from additional_io import COMPRESSION_VARIABLE, THREADS_VARIABLE
+    os.environ[THREADS_VARIABLE] = str(n_jobs)
+    if options.compression_level is not None:
+        os.environ[COMPRESSION_VARIABLE] = str(options.compression_level)
+
     def connectome(subject_list, base_directory, out_directory):
 
         # ==================================================================
@@ -52,9 +70,11 @@ def main():
         from nipype.interfaces.utility import Merge
         import numpy as np
         from additional_interfaces import AtlasValues
+        from additional_interfaces import AverageResponse
         from additional_interfaces import AparcStats
         from additional_interfaces import CalcMatrix
         from additional_interfaces import FreeSurferValues
+        from additional_interfaces import ResponseFunction
         from additional_interfaces import Tractography
         from additional_pipelines import DWIPreproc
         from additional_pipelines import SubjectSpaceParcellation
@@ -86,12 +106,14 @@ def main():
         t1_preproc = pe.Node(interface=T1Preproc(), name='t1_preproc')
         t1_preproc.inputs.out_directory = out_directory + '/connectome/'
         t1_preproc.inputs.template_directory = template_directory
+        t1_preproc.inputs.n_jobs = n_jobs
 
         # DWI processing
         dwi_preproc = pe.Node(interface=DWIPreproc(), name='dwi_preproc')
         dwi_preproc.inputs.out_directory = out_directory + '/connectome/'
         dwi_preproc.inputs.acqparams = acquisition_parameters
         dwi_preproc.inputs.index_file = index_file
+        dwi_preproc.inputs.n_jobs = n_jobs
         dwi_preproc.inputs.out_directory = out_directory + '/connectome/'
 
         # Eroding the brain mask
@@ -100,6 +122,16 @@ def main():
         # Reconstruction and tractography
         tractography = pe.Node(interface=Tractography(), name='tractography')
         tractography.iterables = ('model', ['CSA', 'CSD'])
+        tractography.inputs.n_jobs = n_jobs
+        tractography.inputs.model_cache = out_directory + '/connectome/model_cache/'
+        if fused:
+            tractography.inputs.save_tractogram = False
+
+        # CSD response functions, estimated per subject and averaged over the cohort
+        response = pe.Node(interface=ResponseFunction(), name='response')
+        response.inputs.model_cache = out_directory + '/connectome/model_cache/'
+        average_response = pe.JoinNode(interface=AverageResponse(), joinsource='infosource',
+                                       joinfield=['response_files'], name='average_response')
 
         # smoothing the tracts
         smooth = pe.Node(interface=dtk.SplineFilter(
@@ -125,14 +157,16 @@ def main():
         merge = pe.Node(interface=Merge(3), name='merge')
 
         # calcuating the connectome matrix
-        calc_matrix = pe.MapNode(interface=CalcMatrix(), name='calc_matrix', iterfield=['scalar_file'])
-        calc_matrix.iterables = ('threshold', np.arange(0,20,10))
+        calc_matrix = pe.Node(interface=CalcMatrix(), name='calc_matrix')
+        calc_matrix.inputs.thresholds = list(range(0, 20, 10))
+        # Matrices are stored under the subject ID, with the model as its own field
+        if cohort_store:
+            calc_matrix.inputs.cohort_store = os.path.abspath(cohort_store)
+            calc_matrix.inputs.atlas_name = 'aparc'
 
         # Getting values of diffusion measures
-        FA_values = pe.Node(interface=AtlasValues(), name='FA_values')
-        RD_values = pe.Node(interface=AtlasValues(), name='RD_values')
-        AD_values = pe.Node(interface=AtlasValues(), name='AD_values')
-        MD_values = pe.Node(interface=AtlasValues(), name='MD_values')
+        merge_measures = pe.Node(interface=Merge(4), name='merge_measures')
+        atlas_values = pe.Node(interface=AtlasValues(), name='atlas_values')
 
         # Getting additional surface measures
         aparcstats = pe.Node(interface=AparcStats(), name='aparcstats')
@@ -163,8 +197,16 @@ def main():
         connectome.connect(dwi_preproc, 'FA', tractography, 'FA')
         connectome.connect(erode_mask, 'out_file', tractography, 'brain_mask')
 
+        if group_response:
+            connectome.connect(dwi_preproc, 'dwi', response, 'in_file')
+            connectome.connect(selectfiles, 'bval', response, 'bval')
+            connectome.connect(selectfiles, 'bvec', response, 'bvec')
+            connectome.connect(response, 'response_file', average_response, 'response_files')
+            connectome.connect(average_response, 'response_file', tractography, 'response_file')
+
         # Smoothing the trackfile
-        connectome.connect(tractography, 'out_track', smooth, 'track_file')
+        if not fused:
+            connectome.connect(tractography, 'out_track', smooth, 'track_file')
 
         # Preprocessing the T1-weighted file
         connectome.connect(infosource, 'subject_id', t1_preproc, 'subject_id')
@@ -182,23 +224,28 @@ def main():
         connectome.connect(bbreg, 'out_reg_file', applyreg, 'reg_file')
         connectome.connect(subject_parcellation, 'renum_expanded', applyreg, 'target_file')
 
-        # Calculating the FA connectome
-        connectome.connect(tractography, 'out_track', calc_matrix, 'track_file')
+        # Calculating the FA connectome from the memory-mapped tractogram
+        # container, or from the connectome accumulated while tracking
+        if fused:
+            connectome.connect(applyreg, 'transformed_file', tractography, 'ROI_file')
+            connectome.connect(tractography, 'connectome_file', calc_matrix, 'track_file')
+        else:
+            connectome.connect(tractography, 'out_file', calc_matrix, 'track_file')
         connectome.connect(dwi_preproc, 'FA', merge, 'in1')
         connectome.connect(dwi_preproc, 'RD', merge, 'in2')
         connectome.connect(tractography, 'GFA', merge, 'in3')
         connectome.connect(merge, 'out', calc_matrix, 'scalar_file')
         connectome.connect(applyreg, 'transformed_file', calc_matrix, 'ROI_file')
+        connectome.connect(infosource, 'subject_id', calc_matrix, 'subject_id')
+        connectome.connect(tractography, 'model', calc_matrix, 'model')
 
         # Getting values for additional measures
-        connectome.connect(dwi_preproc, 'FA', FA_values, 'morpho_filename')
-        connectome.connect(dwi_preproc, 'RD', RD_values, 'morpho_filename')
-        connectome.connect(dwi_preproc, 'AD', AD_values, 'morpho_filename')
-        connectome.connect(dwi_preproc, 'MD', MD_values, 'morpho_filename')
-        connectome.connect(applyreg, 'transformed_file', FA_values, 'atlas_filename')
-        connectome.connect(applyreg, 'transformed_file', RD_values, 'atlas_filename')
-        connectome.connect(applyreg, 'transformed_file', AD_values, 'atlas_filename')
-        connectome.connect(applyreg, 'transformed_file', MD_values, 'atlas_filename')
+        connectome.connect(dwi_preproc, 'FA', merge_measures, 'in1')
+        connectome.connect(dwi_preproc, 'RD', merge_measures, 'in2')
+        connectome.connect(dwi_preproc, 'AD', merge_measures, 'in3')
+        connectome.connect(dwi_preproc, 'MD', merge_measures, 'in4')
+        connectome.connect(merge_measures, 'out', atlas_values, 'morpho_filename')
+        connectome.connect(applyreg, 'transformed_file', atlas_values, 'atlas_filename')
 
         # Getting FreeSurfer morphological values
         connectome.connect(t1_preproc, 'subject_id', aparcstats, 'subject_id')
@@ -0,0 +1,26 @@
+#! /usr/bin/env python
+import optparse
+import sys
+
+
+# ======================================================================
+# Runtime and noise reduction of the denoising backends on synthetic data
+
+def main():
+    p = optparse.OptionParser()
+
+    p.add_option('--methods', '-m', default='nlmeans,nlmeans_blockwise,mppca')
+    p.add_option('--n_volumes', '-v', type='int', default=31)
+    p.add_option('--noise_level', '-l', type='float', default=.05)
+    p.add_option('--n_jobs', '-n', type='int', default=1)
+
+    options, arguments = p.parse_args()
+
+    from additional_denoise import benchmark_denoisers
+    results = benchmark_denoisers([method for method in options.methods.split(',') if method],
+                                  n_jobs=options.n_jobs, n_volumes=options.n_volumes,
+                                  noise_level=options.noise_level)
+    print(results.to_string(float_format='%.3f'))
+
+if __name__ == '__main__':
+    sys.exit(main())